@@ -1,16 +1,38 @@
 import os
+import time
+import asyncio
 from datetime import datetime
 import discord
 import unidecode
-from piemanese.translator import Translator
+
+def write_metrics(metrics, path):
+    """Replace path with the current metrics, in Prometheus text format."""
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(metrics.to_prometheus())
+    os.replace(f'{path}.tmp', path)
 
 def main():
     assert 'DISCORD_USER_IDS' in os.environ
     assert 'DISCORD_TOKEN' in os.environ
 
-    translator = Translator()
+    metrics_file = os.environ.get('METRICS_FILE')
+    if 'TRANSLATOR_URL' in os.environ:
+        # models are held by a separate piemanese.serve process
+        from piemanese.serve import TranslatorClient
+        translator = None
+        async_translator = TranslatorClient(os.environ['TRANSLATOR_URL'])
+    else:
+        from piemanese.translator import Translator
+        from piemanese.async_translator import AsyncTranslator
+        translator = Translator(tm_cache_file=os.environ.get('TM_CACHE_FILE'),
+            warm_up=True)
+        print('Startup:', translator.startup_stats())
+        if metrics_file:
+            translator.enable_metrics()
+        async_translator = AsyncTranslator(translator)
     client = discord.Client()
     user_ids = os.environ['DISCORD_USER_IDS'].split(',')
+    metrics_written = 0
 
     @client.event
     async def on_ready():
@@ -18,6 +40,7 @@ def main():
 
     @client.event
     async def on_message(msg):
+        nonlocal metrics_written
         if not msg.content:
             return
         if msg.author == client.user:
@@ -27,13 +50,33 @@ def main():
         now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         print(f'[{now}] [{msg.channel}] {msg.author}: {msg.content}')
         msg_clean = unidecode.unidecode(msg.content)
-        msg_clean = ' '.join(translator.tokenize(msg_clean))
-        msg_translated = translator(msg_clean)
+        msg_clean = ' '.join(msg_clean.lower().split())
+        try:
+            msg_translated = await async_translator.translate(msg_clean)
+        except asyncio.QueueFull:
+            print('translation queue full, dropping message')
+            return
         if msg_translated and msg_clean != msg_translated:
             await msg.channel.send(msg_translated)
             print('translation:', msg_translated)
+        if translator is not None and translator.metrics is not None \
+                and time.time() - metrics_written > 60:
+            # on the translation thread, so metrics are not read mid-update
+            metrics_written = time.time()
+            await asyncio.get_running_loop().run_in_executor(
+                async_translator.executor, write_metrics, translator.metrics,
+                metrics_file)
 
-    client.run(os.environ['DISCORD_TOKEN'])
+    try:
+        client.run(os.environ['DISCORD_TOKEN'])
+    finally:
+        if translator is not None:
+            async_translator.close()
+            print('Batching:', async_translator.stats())
+            translator.save_cache()
+            print('TM cache:', translator.decoder.tm.cache_stats())
+            if translator.metrics is not None:
+                write_metrics(translator.metrics, metrics_file)
 
 if __name__ == '__main__':
     main()
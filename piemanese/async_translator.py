@@ -0,0 +1,111 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncTranslator:
+    """
+    asyncio front end to a Translator. Sentences submitted within max_delay
+    seconds of each other are decoded as one batch on a worker thread, so
+    the models never block the event loop.
+    """
+    def __init__(self, translator, max_batch_size=64, max_delay=0.005,
+            max_queue_size=256, executor=None):
+        """
+        max_batch_size: max number of sentences per translate_batch call.
+        max_delay: seconds to wait for more sentences after the first one
+            of a batch arrives.
+        max_queue_size: max number of sentences waiting for a batch, beyond
+            which translate raises asyncio.QueueFull instead of waiting.
+        executor: runs translate_batch. Defaults to a single worker thread,
+            since the translator (and its TM cache) is not thread safe.
+        """
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_queue_size = max_queue_size
+        self.executor = executor or ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix='translator')
+        self.queue = None
+        self.worker = None
+        self.n_batches = 0
+        self.n_sents = 0
+        self.n_rejected = 0
+
+    def start(self):
+        """Starts the batching task on the running event loop."""
+        if self.worker is None:
+            self.queue = asyncio.Queue(self.max_queue_size)
+            self.worker = asyncio.create_task(self._run())
+
+    async def translate(self, pi_sent):
+        """
+        Translates a sentence along with whatever else arrives in the same
+        batching window. Raises asyncio.QueueFull right away if too many
+        sentences are already waiting.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((pi_sent, future))
+        except asyncio.QueueFull:
+            self.n_rejected += 1
+            raise
+        return await future
+
+    async def _next_batch(self):
+        """Waits for a sentence, then collects more until the window ends."""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # skip sentences whose callers stopped waiting
+        return [(pi_sent, future) for pi_sent, future in batch
+            if not future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            pi_sents = [pi_sent for pi_sent, _ in batch]
+            try:
+                en_sents = await loop.run_in_executor(self.executor,
+                    self.translator.translate_batch, pi_sents,
+                    self.max_batch_size)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.n_batches += 1
+            self.n_sents += len(batch)
+            for (_, future), en_sent in zip(batch, en_sents):
+                if not future.done():
+                    future.set_result(en_sent)
+
+    def stats(self):
+        return {
+            'batches': self.n_batches,
+            'sentences': self.n_sents,
+            'mean_batch_size': self.n_sents / self.n_batches
+                if self.n_batches else 0,
+            'rejected': self.n_rejected,
+            'queued': self.queue.qsize() if self.queue else 0
+        }
+
+    def close(self):
+        """Waits for the batch being decoded, if any, and stops the worker."""
+        if self.worker is not None and not self.worker.get_loop().is_closed():
+            self.worker.cancel()
+            self.worker = None
+        self.executor.shutdown(wait=True)
@@ -1,10 +1,30 @@
 import re
 import math
+import time
+import numpy as np
+from .metrics import timed, COUNT_BUCKETS
+
+# below these sizes, numpy's per call overhead outweighs vectorizing:
+# LM memo misses per lookup batch, and hypotheses x candidates per step
+MIN_BULK_LM_QUERIES = 8
+MIN_MATRIX_SIZE = 256
 
 class Decoder:
-    def __init__(self, lm, tm):
+    def __init__(self, lm, tm, mode='beam'):
+        """
+        mode='beam': top n beam search, ranking by length normalized score.
+        mode='viterbi': exact search over the TM candidate lattice for the
+            highest total log probability.
+        """
+        if mode not in ['beam', 'viterbi']:
+            raise ValueError(f'Unknown decoder mode: {mode}')
         self.lm = lm
         self.tm = tm
+        self.mode = mode
+        # search space size per sentence of the last decode_batch call
+        self.search_stats = []
+        # optional Metrics, see Translator.set_metrics
+        self.metrics = None
 
     def _split_punctuation(self, word):
         """Splits a token into word, punctuation"""
@@ -21,14 +41,55 @@ class Decoder:
             argmax_e p(pi|e) * p(e)
             = argmax_e p(e|pi)
 
-        returns: [(log_prob, en_tokens)]
-        n: number of beams.
+        returns: [(log_prob, en_tokens)], a single result in viterbi mode.
+        n: number of beams, and TM candidates per word.
         verbose=0: print nothing.
         verbose=1: show top n sentences at each decoding step.
         verbose=2: also show tm and lm scores at each step.
         """
+        return self.decode_batch([pi_tokens], verbose=verbose, n=n)[0]
+
+    def decode_batch(self, pi_sents, verbose=0, n=4):
+        """
+        Decode many tokenized sentences, scoring the words of all of them
+        with a single TM call before beam searching each sentence.
+
+        returns: [[(log_prob, en_tokens)]], one list per sentence.
+        """
+        with timed(self.metrics, 'preprocess'):
+            pi_sents = [self._prepare(pi_tokens) for pi_tokens in pi_sents]
+        with timed(self.metrics, 'tm'):
+            tm_scores_all = self.tm.multiple_scores(
+                [word for words, puncs in pi_sents for word in words], top_n=n)
+        search = self._viterbi if self.mode == 'viterbi' else self._beam_search
+        results = []
+        self.search_stats = []
+        for words, puncs in pi_sents:
+            start = time.perf_counter()
+            with timed(self.metrics, 'search'):
+                topn_sents, stats = search(words, puncs, tm_scores_all,
+                    verbose, n)
+            stats['seconds'] = time.perf_counter() - start
+            results.append(topn_sents)
+            self.search_stats.append(stats)
+        if self.metrics is not None:
+            self._record_metrics(pi_sents, tm_scores_all)
+        return results
+
+    def _record_metrics(self, pi_sents, tm_scores_all):
+        self.metrics.inc('decoded_sentences', len(pi_sents))
+        self.metrics.observe_many('candidates_per_token',
+            [len(tm_scores_all[word]) for words, _ in pi_sents
+                for word in words])
+        for key in ['states', 'transitions']:
+            values = [stats[key] for stats in self.search_stats]
+            self.metrics.inc(f'search_{key}', sum(values))
+            self.metrics.observe_many(f'search_{key}_per_sentence', values,
+                COUNT_BUCKETS)
+
+    def _prepare(self, pi_tokens):
+        """Splits punctuation and cleans the words of a sentence."""
         pi_tokens = ['<s>'] + pi_tokens + ['</s>']
-        topn_sents = [(0, [])]
         pi_tokens_word = []
         pi_tokens_punc = []
         for pi_token in pi_tokens:
@@ -36,55 +97,279 @@ class Decoder:
             pi_tokens_word.append(word)
             pi_tokens_punc.append(punc)
         pi_tokens_word = self.tm.clean_words(pi_tokens_word)
-        tm_scores_all = self.tm.multiple_scores(pi_tokens_word, top_n=n)
-        for i, (word, punc) in enumerate(zip(pi_tokens_word, pi_tokens_punc)):
+        return self._merge_phrases(pi_tokens_word, pi_tokens_punc)
+
+    def _merge_phrases(self, pi_tokens_word, pi_tokens_punc):
+        """
+        Merges the longest multi-word TM replacement phrase at each
+        position into a single space separated word, so that it is
+        translated in one step without scoring its words separately.
+        Phrases cannot span punctuation, except after their last word.
+        """
+        # limits[i]: end of the longest span from i without inner punctuation
+        limits = [len(pi_tokens_word)] * len(pi_tokens_word)
+        for i in range(len(pi_tokens_word) - 2, -1, -1):
+            limits[i] = i + 1 if pi_tokens_punc[i] else limits[i + 1]
+        words = []
+        puncs = []
+        i = 0
+        while i < len(pi_tokens_word):
+            match = self.tm.match_replacement(pi_tokens_word, i, limits[i]) \
+                if limits[i] - i > 1 else None
+            end = match[0] if match else i + 1
+            words.append(' '.join(pi_tokens_word[i:end]))
+            puncs.append(pi_tokens_punc[end - 1])
+            i = end
+        return words, puncs
+
+    def _beam_search(self, pi_tokens_word, pi_tokens_punc, tm_scores_all,
+            verbose=0, n=4):
+        # hypotheses are (log_prob, n_tokens, lm_state, back pointer), where
+        # the back pointer is (previous hypothesis, tokens added)
+        topn_hyps = [(0, 0, self.lm.null_state(), None)]
+        lm_memo = {}
+        stats = {'states': 1, 'transitions': 0}
+        for word, punc in zip(pi_tokens_word, pi_tokens_punc):
             tm_scores = tm_scores_all[word]
             if not tm_scores:
                 continue
-            new_topn_sents = []
-            for p, en_tokens in topn_sents:
-                combined_scores = {}
-                lm_scores = {}
-                for tm_word, tm_score in tm_scores.items():
-                    lm_score = 1
-                    tm_word_tokens = tm_word.split()
-                    context = en_tokens[-self.lm.order+1:]
-                    context = [self._split_punctuation(t)[0] for t in context]
-                    for w in tm_word_tokens:
-                        lm_score *= self.lm.score(w, context)
-                        if len(context) == self.lm.order-1:
-                            context = context[1:] + [w]
-                        else:
-                            context.append(w)
-                    lm_scores[tm_word] = lm_score
-                combined_scores = self._interpolate_scores(tm_scores, lm_scores)
-                topn_words = sorted(combined_scores.items(),
-                    key=lambda x: -x[1])[:n]
-                if verbose >= 2:
-                    print([(w, p, tm_scores[w], lm_scores[w])
-                        for w, p in topn_words])
-                for tm_word, combined_score in topn_words:
-                    new_p = p + combined_score
-                    new_tokens = en_tokens + (tm_word + punc).split()
-                    new_topn_sents.append((new_p, new_tokens))
-            topn_sents = sorted(new_topn_sents,
-                key=lambda x: -x[0] / len(x[1]))[:n]
+            topn_hyps = self._expand(topn_hyps, tm_scores, punc, lm_memo,
+                stats, verbose, n, beam=True)
+            if verbose:
+                print([(hyp[0], self._backtrack(hyp)) for hyp in topn_hyps])
+        return ([(hyp[0], self._backtrack(hyp)[1:-1]) for hyp in topn_hyps],
+            stats)
+
+    def _viterbi(self, pi_tokens_word, pi_tokens_punc, tm_scores_all,
+            verbose=0, n=4):
+        """
+        Exact search by dynamic programming over (position, lm state). Each
+        step's score only depends on the previous lm state and the chosen
+        candidate, so keeping the best hypothesis per lm state is optimal
+        for the total (not length normalized) log probability.
+        """
+        # one best hypothesis per lm state, same layout as in _beam_search
+        hyps = [(0, 0, self.lm.null_state(), None)]
+        lm_memo = {}
+        stats = {'states': 1, 'transitions': 0}
+        for word, punc in zip(pi_tokens_word, pi_tokens_punc):
+            tm_scores = tm_scores_all[word]
+            if not tm_scores:
+                continue
+            hyps = self._expand(hyps, tm_scores, punc, lm_memo, stats,
+                verbose, n, beam=False)
             if verbose:
-                print(topn_sents)
-        return [(log_p, en_tokens[1:-1]) for log_p, en_tokens in topn_sents]
+                print(f'{len(hyps)} lm states')
+        # hypotheses are kept best first
+        best = hyps[0]
+        return [(best[0], self._backtrack(best)[1:-1])], stats
+
+    def _expand(self, hyps, tm_scores, punc, lm_memo, stats, verbose, n,
+            beam):
+        """
+        Expands hypotheses with the TM candidates of a word.
+        beam=True: each hypothesis expands its top n candidates, expansions
+            are recombined by (lm state, n tokens) and ranked by length
+            normalized score, keeping the n best.
+        beam=False: all expansions are recombined by lm state and ranked by
+            total log probability.
+        Small grids are scored in python, larger ones with numpy arrays,
+        both giving the same hypotheses.
+
+        returns: new hypotheses, best first
+        """
+        size = len(hyps) * len(tm_scores)
+        stats['transitions'] += size
+        expand = self._expand_matrix if size >= MIN_MATRIX_SIZE \
+            else self._expand_scalar
+        hyps = expand(hyps, tm_scores, punc, lm_memo, verbose, n, beam)
+        stats['states'] += len(hyps)
+        return hyps
 
-    def _interpolate_scores(self, tm_scores, lm_scores):
-        # TODO find better way to interpolate tm/lm lm_scores
+    def _expand_scalar(self, hyps, tm_scores, punc, lm_memo, verbose, n,
+            beam):
+        tm_words = list(tm_scores)
+        with timed(self.metrics, 'lm'):
+            lm_logscores, lm_states = self._lm_scores(
+                [hyp[2] for hyp in hyps], self._word_ids(tm_words), lm_memo)
+        tm_log = self._log_normalize_list([tm_scores[w] for w in tm_words])
+        new_tokens = [(w + punc).split() for w in tm_words]
+        # best (rank, hypothesis) per recombination key, in first seen order
+        best = {}
+        for b, hyp in enumerate(hyps):
+            lm_probs = [10.0 ** s for s in lm_logscores[b]]
+            combined = [t + l for t, l in
+                zip(tm_log, self._log_normalize_list(lm_probs))]
+            cands = range(len(tm_words))
+            if beam:
+                cands = sorted(cands, key=lambda c: -combined[c])[:n]
+                if verbose >= 2:
+                    print([(tm_words[c], combined[c], tm_scores[tm_words[c]],
+                        lm_probs[c]) for c in cands])
+            for c in cands:
+                p = hyp[0] + combined[c]
+                n_tokens = hyp[1] + len(new_tokens[c])
+                lm_state = lm_states[b][c]
+                key = (lm_state, n_tokens) if beam else lm_state
+                rank = p / max(n_tokens, 1) if beam else p
+                if key not in best or rank > best[key][0]:
+                    best[key] = (rank, (p, n_tokens, lm_state,
+                        (hyp, new_tokens[c])))
+        ranked = sorted(best.values(), key=lambda x: -x[0])
+        return [hyp for _, hyp in (ranked[:n] if beam else ranked)]
+
+    def _expand_matrix(self, hyps, tm_scores, punc, lm_memo, verbose, n,
+            beam):
+        tm_words, combined, lm_probs, lm_states, n_new_tokens = \
+            self._step_scores([hyp[2] for hyp in hyps], tm_scores, punc,
+                lm_memo)
+        if beam:
+            # each hypothesis only expands its own top n candidates
+            top = self._top_k(combined, n)
+            if verbose >= 2:
+                for b, row in enumerate(top):
+                    print([(tm_words[c], combined[b, c], tm_scores[tm_words[c]],
+                        lm_probs[b, c]) for c in row])
+            b_idx = np.repeat(np.arange(len(hyps)), top.shape[1])
+            c_idx = top.ravel()
+        else:
+            b_idx, c_idx = np.divmod(np.arange(combined.size), len(tm_words))
+        p = np.array([hyp[0] for hyp in hyps])[b_idx] + combined[b_idx, c_idx]
+        n_tokens = np.array([hyp[1] for hyp in hyps])[b_idx] \
+            + n_new_tokens[c_idx]
+        new_states = lm_states[b_idx, c_idx]
+        if beam:
+            # the length normalized rank of hypotheses with the same lm state
+            # but different lengths can still change order later
+            keep = self._recombine(p / np.maximum(n_tokens, 1),
+                np.stack([new_states, n_tokens.astype(np.uint64)], axis=1))[:n]
+        else:
+            keep = self._recombine(p, new_states)
+        return self._new_hyps(hyps, tm_words, punc, keep, b_idx, c_idx, p,
+            n_tokens, new_states)
+
+    def _new_hyps(self, hyps, tm_words, punc, keep, b_idx, c_idx, p,
+            n_tokens, lm_states):
+        """Builds the hypotheses of the expansions selected by keep."""
+        return [(p, n_tokens, lm_state, (hyps[b], (tm_words[c] + punc).split()))
+            for p, n_tokens, lm_state, b, c in zip(p[keep].tolist(),
+                n_tokens[keep].tolist(), lm_states[keep].tolist(),
+                b_idx[keep].tolist(), c_idx[keep].tolist())]
+
+    def _top_k(self, scores, k):
+        """
+        Indices of the k best scores along the last axis, best first. Ties
+        keep index order, as a stable sort would.
+        """
+        if scores.shape[-1] <= k:
+            return np.argsort(-scores, axis=-1, kind='stable')
+        top = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+        top.sort(axis=-1)
+        order = np.argsort(-np.take_along_axis(scores, top, -1), axis=-1,
+            kind='stable')
+        return np.take_along_axis(top, order, -1)
+
+    def _recombine(self, keys, groups):
+        """
+        Recombines expansions in the same group (rows of groups if 2d),
+        e.g. reaching the same lm state, since they are scored identically
+        from here on. The best by key survives (the earliest on ties), and
+        survivors are ranked by key, with ties in order of their group's
+        first expansion.
+
+        returns: indices of surviving expansions, best first
+        """
+        order = np.lexsort((np.arange(len(keys)), -keys))
+        # np.unique sorts by group, so both calls align group for group
+        _, best = np.unique(groups[order], return_index=True, axis=0)
+        best = order[best]
+        _, first_seen = np.unique(groups, return_index=True, axis=0)
+        return best[np.lexsort((first_seen, -keys[best]))]
+
+    def _backtrack(self, hyp):
+        """Recover the English tokens of a hypothesis."""
+        token_lists = []
+        while hyp[3] is not None:
+            hyp, tokens = hyp[3]
+            token_lists.append(tokens)
+        return [t for tokens in reversed(token_lists) for t in tokens]
+
+    def _step_scores(self, lm_states, tm_scores, punc, lm_memo):
+        """
+        Scores every TM candidate after every hypothesis state at once.
+
+        returns: (candidates, combined log scores, lm probs, new lm states,
+            tokens per candidate), arrays of shape (beams, candidates) except
+            for the first and last
+        """
+        tm_words = list(tm_scores)
+        with timed(self.metrics, 'lm'):
+            lm_logscores, new_states = self._lm_scores(lm_states,
+                self._word_ids(tm_words), lm_memo)
+        lm_probs = 10.0 ** np.array(lm_logscores, dtype=np.float64)
+        new_states = np.array(new_states, dtype=np.uint64)
+        # TODO find better way to interpolate tm/lm scores
         # upweight tm score if lm probs are all low etc
-        tm_scores = self._log_normalize_scores(tm_scores)
-        lm_scores = self._log_normalize_scores(lm_scores)
-        combined_scores = {}
-        for word in tm_scores:
-            combined_scores[word] = tm_scores[word] + lm_scores[word]
-        return combined_scores
-
-    def _log_normalize_scores(self, scores):
-        z = max(sum(scores.values()), 1)
-        log_normalized_scores = {w: math.log(p / z, 10) if p > 0 else -99
-            for w, p in scores.items()}
-        return log_normalized_scores
+        tm_probs = np.array([tm_scores[w] for w in tm_words], dtype=np.float64)
+        combined = self._log_normalize(tm_probs)[None, :] \
+            + self._log_normalize(lm_probs)
+        n_tokens = np.array([len((w + punc).split()) for w in tm_words])
+        return tm_words, combined, lm_probs, new_states, n_tokens
+
+    def _word_ids(self, tm_words):
+        """LM word ids of the tokens of each TM candidate."""
+        return [[self.lm.word_id(w) for w in tm_word.split()]
+            for tm_word in tm_words]
+
+    def _lm_scores(self, lm_states, tm_word_ids, lm_memo):
+        """
+        Score every TM candidate after every hypothesis state with the LM,
+        for (state, word) pairs not already in lm_memo. Large batches of
+        lookups in table backed LMs use one vectorized call per candidate
+        token, the rest are cheaper to score one by one.
+        returns: (lm log10 probs, new lm states), lists of shape
+            (beams, candidates)
+        """
+        n_beams, n_cands = len(lm_states), len(tm_word_ids)
+        lm_logscores = [[0] * n_cands for _ in range(n_beams)]
+        states = [[state] * n_cands for state in lm_states]
+        for j in range(max(len(ids) for ids in tm_word_ids)):
+            pairs = [(b, c) for b in range(n_beams) for c in range(n_cands)
+                if len(tm_word_ids[c]) > j]
+            keys = [(states[b][c], tm_word_ids[c][j]) for b, c in pairs]
+            misses = list(dict.fromkeys(k for k in keys if k not in lm_memo))
+            if self.metrics is not None:
+                self.metrics.inc('lm_memo_lookups', len(keys))
+                self.metrics.inc('lm_memo_misses', len(misses))
+            if len(misses) >= MIN_BULK_LM_QUERIES \
+                    and not isinstance(self.lm.prob, dict):
+                logscores, new_states = self.lm.advance_many(
+                    np.array([k[0] for k in misses], dtype=np.uint64),
+                    np.array([k[1] for k in misses], dtype=np.uint64))
+                lm_memo.update(zip(misses,
+                    zip(logscores.tolist(), new_states.tolist())))
+            else:
+                for key in misses:
+                    lm_memo[key] = self.lm.advance(*key)
+            for (b, c), key in zip(pairs, keys):
+                logscore, states[b][c] = lm_memo[key]
+                lm_logscores[b][c] += logscore
+        return lm_logscores, states
+
+    def _log_normalize(self, scores):
+        """
+        Log10 of scores normalized along the last axis by max(sum, 1), and
+        -99 where a score is 0 or not finite. Non-finite scores are left
+        out of the sum.
+        """
+        valid = np.isfinite(scores) & (scores > 0)
+        z = np.maximum(np.where(valid, scores, 0).sum(axis=-1,
+            keepdims=True), 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(valid, np.log10(scores / z), -99)
+
+    def _log_normalize_list(self, scores):
+        """_log_normalize of a list of scores, without numpy."""
+        valid = [0 < p < math.inf for p in scores]
+        z = max(sum(p for p, v in zip(scores, valid) if v), 1)
+        return [math.log10(p / z) if v else -99 for p, v in zip(scores, valid)]
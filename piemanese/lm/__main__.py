@@ -1,6 +1,6 @@
 import argparse
 import os.path
-from .lm import train, debug
+from .lm import train, update, debug, convert, prune
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -13,12 +13,38 @@ if __name__ == '__main__':
     train_parser.add_argument('--lm_file', default='lm.pkl', help='Name of LM file')
     train_parser.add_argument('--order', default=3, type=int, help='Max ngram order')
     train_parser.add_argument('--vocab_dir', default=f'{lm_dir}/../vocab/', help='Path to vocab directory')
+    train_parser.add_argument('--n_workers', default=1, type=int, help='Number of counting processes, >1 to spill sorted runs to disk and merge them into arrays instead of Python dicts')
+    train_parser.add_argument('--tmp_dir', help='Directory for spilled partial counts')
+    train_parser.add_argument('--max_shard_ngrams', default=10000000, type=int, help='Max distinct ngrams a worker holds in memory before spilling')
+    train_parser.add_argument('--counts_file', help='Where to save raw ngram counts for later updates (default: <lm_file>.counts.npz)')
     train_parser.set_defaults(fn=train)
 
+    update_parser = subparsers.add_parser('update', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    update_parser.add_argument('--dataset_files_pattern', required=True, help='Pattern to select new training files')
+    update_parser.add_argument('--lm_file', default='lm.pkl', help='Name of LM file to update')
+    update_parser.add_argument('--counts_file', help='Raw ngram counts saved by train (default: <lm_file>.counts.npz)')
+    update_parser.add_argument('--n_workers', default=1, type=int, help='Number of counting processes, >1 to spill sorted runs to disk and merge them into arrays instead of Python dicts')
+    update_parser.add_argument('--tmp_dir', help='Directory for spilled partial counts')
+    update_parser.add_argument('--max_shard_ngrams', default=10000000, type=int, help='Max distinct ngrams a worker holds in memory before spilling')
+    update_parser.set_defaults(fn=update)
+
     debug_parser = subparsers.add_parser('debug', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     debug_parser.add_argument('--lm_file', default='lm.pkl', help='Name of LM file')
     debug_parser.set_defaults(fn=debug)
 
+    convert_parser = subparsers.add_parser('convert', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    convert_parser.add_argument('--lm_file', default='lm.pkl', help='Name of LM file to convert')
+    convert_parser.add_argument('--output_file', default='lm.bin', help='Name of output LM file (.bin for binary format)')
+    convert_parser.add_argument('--quantize_bits', type=int, choices=[8, 16], help='Store binary LM probabilities as 8/16 bit codes')
+    convert_parser.set_defaults(fn=convert)
+
+    prune_parser = subparsers.add_parser('prune', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    prune_parser.add_argument('--lm_file', default='lm.pkl', help='Name of LM file to prune')
+    prune_parser.add_argument('--output_file', default='lm_pruned.bin', help='Name of output LM file (.bin for binary format)')
+    prune_parser.add_argument('--threshold', default=1e-8, type=float, help='Relative entropy threshold below which ngrams are pruned')
+    prune_parser.add_argument('--quantize_bits', type=int, choices=[8, 16], help='Store binary LM probabilities as 8/16 bit codes')
+    prune_parser.set_defaults(fn=prune)
+
     args = parser.parse_args()
     if args.fn:
         args.fn(args)
@@ -1,10 +1,22 @@
 import argparse
+import os.path
 import math
+import mmap
 import glob
+import heapq
+import struct
+import tempfile
 import fileinput
-from collections import Counter
-from nltk.lm.preprocessing import padded_everygram_pipeline
+import multiprocessing
+from collections import Counter, defaultdict
+import numpy as np
 import dill as pickle
+from ..metrics import COUNT_BUCKETS
+
+BINARY_MAGIC = b'PIELMBIN'
+BINARY_HEADER = struct.Struct('<8sQQQQ')
+QUANTIZED_MAGIC = b'PIELMQNT'
+QUANTIZED_HEADER = struct.Struct('<8sQQQQQ')
 
 class ModifiedKneserNey:
     """
@@ -27,6 +39,12 @@ class ModifiedKneserNey:
     def count(self, ngrams):
         # regular ngram counts
         self.counts += Counter(self.hash_fn(ngram) for ngram in ngrams)
+        self.compute_statistics()
+
+    def compute_statistics(self):
+        """Compute count statistics and discounts from self.counts."""
+        null_ctx = self.hash_fn(None)
+        self.counts.pop(null_ctx, None)
         # counts of counts
         self.counts_of_counts = Counter(self.counts.values())
         # preceding word type counts
@@ -42,23 +60,25 @@ class ModifiedKneserNey:
                 for ngram, c in self.counts.items() if c == i + 1)
         self.post_counts[-1] = Counter(self.hash_remove_last_fn(ngram)
             for ngram, c in self.counts.items() if c >= len(self.post_counts))
-        # modified kneser ney discounts
+        self.compute_discounts()
+        # total unigram count
+        self.counts[null_ctx] = sum(c for ngram, c in self.counts.items()
+            if self.hash_remove_first_fn(ngram) == null_ctx)
+
+    def compute_discounts(self):
+        """Modified Kneser-Ney discounts from self.counts_of_counts."""
         n = [self.counts_of_counts.get(i + 1, 0)
             for i in range(len(self.kn_discount) + 1)]
         d = n[0] / (n[0] + 2 * n[1])
         self.kn_discount = [(i + 1) - (i + 2) * d * n[i + 1] / n[i]
             for i in range(len(self.kn_discount))]
-        # total unigram count
-        null_ctx = self.hash_fn(None)
-        self.counts[null_ctx] = sum(c for ngram, c in self.counts.items()
-            if self.hash_remove_first_fn(ngram) == null_ctx)
 
     def prob_backoff(self):
         prob = {}
         backoff = {}
         for ngram_hash in self.counts:
              prob[ngram_hash] = self.kneser_ney_prob(ngram_hash)
-             if ngram_hash in self.post_counts:
+             if any(ngram_hash in c for c in self.post_counts):
                  backoff[ngram_hash] = self.kneser_ney_backoff(ngram_hash,
                     self.counts[ngram_hash])
         return prob, backoff
@@ -95,6 +115,222 @@ class ModifiedKneserNey:
             return numer / self.pre_counts_ctx[ctx_hash]
 
 
+class SortedModifiedKneserNey(ModifiedKneserNey):
+    """
+    ModifiedKneserNey over counts held in an NgramTable, computing every
+    statistic, probability and backoff weight with vectorized numpy
+    operations on sorted uint64 arrays. Gives the same results as the dict
+    based class, without creating Python objects per ngram.
+    """
+    def __init__(self, word_bits, order, vocab_size):
+        super().__init__(None, None, None, vocab_size)
+        self.word_bits = word_bits
+        self.order = order
+
+    def _ngram_order(self, ngram_hashes):
+        order = np.zeros(len(ngram_hashes), dtype=np.int64)
+        for k in range(self.order):
+            order += (ngram_hashes >> np.uint64(self.word_bits * k)) != 0
+        return order
+
+    def _remove_first(self, ngram_hashes):
+        masks = np.array([(1 << (self.word_bits * k)) - 1
+            for k in range(self.order)], dtype=np.uint64)
+        order = self._ngram_order(ngram_hashes)
+        return ngram_hashes & masks[np.maximum(order - 1, 0)]
+
+    @staticmethod
+    def _group_sum(keys, values=None):
+        """Sums values (default 1) of equal keys into an NgramTable."""
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        values = np.ones(len(keys), dtype=np.uint64) if values is None \
+            else values[order]
+        if not len(keys):
+            return NgramTable(keys, values)
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        return NgramTable(keys[starts], np.add.reduceat(values, starts))
+
+    @staticmethod
+    def _get(table, keys):
+        found, values = table.lookup(keys)
+        return np.where(found, values, 0).astype(np.float64)
+
+    def compute_statistics(self, counts):
+        """Compute count statistics and discounts from an NgramTable."""
+        B = np.uint64(self.word_bits)
+        keep = counts.keys != 0
+        keys, values = counts.keys[keep], counts.values[keep]
+        # counts of counts
+        count_values, n = np.unique(values, return_counts=True)
+        self.counts_of_counts = dict(zip(count_values.tolist(), n.tolist()))
+        # preceding word type counts
+        self.pre_counts_ngram = self._group_sum(self._remove_first(keys))
+        pre_keys = self.pre_counts_ngram.keys
+        has_ctx = pre_keys != 0
+        self.pre_counts_ctx = self._group_sum(pre_keys[has_ctx] >> B,
+            self.pre_counts_ngram.values[has_ctx])
+        # succeeding word type counts
+        for i in range(len(self.post_counts)):
+            if i < len(self.post_counts) - 1:
+                selected = values == i + 1
+            else:
+                selected = values >= len(self.post_counts)
+            self.post_counts[i] = self._group_sum(keys[selected] >> B)
+        self.compute_discounts()
+        # total unigram count, stored under the null context
+        total = values[self._ngram_order(keys) == 1].sum()
+        self.counts = NgramTable(np.r_[np.uint64(0), keys],
+            np.r_[np.uint64(total), values])
+
+    def _discounted(self, word_count, ctx_count):
+        d = np.array(self.kn_discount)
+        discount = d[np.minimum(word_count, len(d)).astype(np.int64) - 1]
+        return np.maximum(word_count - discount, 0) / ctx_count
+
+    def _backoff(self, ctx_hashes, highest_order=True):
+        numer = 0
+        for d, n_ctx in zip(self.kn_discount, self.post_counts):
+            numer = numer + d * self._get(n_ctx, ctx_hashes)
+        if highest_order:
+            return numer / self._get(self.counts, ctx_hashes)
+        return numer / self._get(self.pre_counts_ctx, ctx_hashes)
+
+    def _prob(self, ngram_hashes, highest_order=True):
+        B = np.uint64(self.word_bits)
+        prob = np.full(len(ngram_hashes), 1 / self.vocab_size)
+        idx = np.flatnonzero(ngram_hashes)
+        if not len(idx):  # base case
+            return prob
+        ngram_hashes = ngram_hashes[idx]
+        ctx_hashes = ngram_hashes >> B
+        if highest_order:
+            word_count = self._get(self.counts, ngram_hashes)
+            ctx_count = self._get(self.counts, ctx_hashes)
+        else:
+            word_count = self._get(self.pre_counts_ngram, ngram_hashes)
+            ctx_count = self._get(self.pre_counts_ctx, ctx_hashes)
+        prob[idx] = self._discounted(word_count, ctx_count) \
+            + self._backoff(ctx_hashes, highest_order) \
+            * self._prob(self._remove_first(ngram_hashes), False)
+        return prob
+
+    def prob_backoff(self):
+        """returns: prob and backoff as NgramTables"""
+        keys = self.counts.keys
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prob = self._prob(keys)
+            has_backoff = np.zeros(len(keys), dtype=bool)
+            for n_ctx in self.post_counts:
+                has_backoff |= n_ctx.lookup(keys)[0]
+            backoff = self._backoff(keys[has_backoff])
+        return NgramTable(keys, prob), \
+            NgramTable(keys[has_backoff], backoff)
+
+
+class NgramTable:
+    """
+    Read-only mapping of ngram hash -> float, stored as a sorted uint64 key
+    array and a float32 value array so it can be backed by a memory map.
+    Values are stored as log10 if log_values is set, and as integer codes
+    into codebook if the table is quantized.
+    """
+    def __init__(self, keys, values, log_values=False, codebook=None):
+        self.keys = keys
+        self.values = values
+        self.log_values = log_values
+        self.codebook = codebook
+
+    @classmethod
+    def from_dict(cls, d, log_values=False, dtype=np.float32):
+        keys = np.fromiter(sorted(d), dtype=np.uint64, count=len(d))
+        values = np.array([d[k] for k in keys.tolist()], dtype=dtype)
+        if log_values:
+            with np.errstate(divide='ignore'):
+                values = np.log10(values)
+        return cls(keys, values, log_values)
+
+    def to_log(self):
+        """Returns this table with float32 log10 values."""
+        if self.log_values:
+            return self
+        with np.errstate(divide='ignore'):
+            values = np.log10(self.values.astype(np.float64))
+        return NgramTable(self.keys, values.astype(np.float32), True)
+
+    def quantize(self, bits):
+        """
+        Returns a copy of this table with values replaced by bits-bit codes
+        into a codebook of value quantiles.
+        """
+        assert self.codebook is None and bits in [8, 16]
+        values = np.asarray(self.values, dtype=np.float32)
+        finite = values[np.isfinite(values)]
+        n = 1 << bits
+        if len(finite):
+            codebook = np.unique(np.quantile(finite,
+                (np.arange(n) + 0.5) / n).astype(np.float32))
+        else:
+            codebook = np.zeros(1, dtype=np.float32)
+        # nearest codebook entry, -inf maps to the smallest
+        midpoints = (codebook[1:] + codebook[:-1]) / 2
+        codes = np.searchsorted(midpoints, values)
+        codes = codes.astype(np.uint8 if bits == 8 else np.uint16)
+        return NgramTable(self.keys, codes, self.log_values, codebook)
+
+    def _value(self, values):
+        if self.codebook is not None:
+            values = self.codebook[values]
+        if self.log_values:
+            return 10 ** values.astype(np.float64)
+        # integer tables, such as counts, keep their values
+        return values.astype(np.float64) if values.dtype.kind == 'f' \
+            else values
+
+    def _find(self, key):
+        if key < 0 or key >= 1 << 64:
+            return -1
+        i = int(np.searchsorted(self.keys, np.uint64(key)))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def lookup(self, keys):
+        """
+        Vectorized get over a uint64 array of keys.
+        returns: (found, values), values are only valid where found.
+        """
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=bool), np.zeros(len(keys))
+        i = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[i] == keys
+        return found, self._value(self.values[i])
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i < 0:
+            return default
+        return self._value(self.values[i:i+1])[0].item()
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys.tolist())
+
+    def items(self):
+        return zip(self.keys.tolist(), self._value(self.values).tolist())
+
+
 class LanguageModel:
     """N-gram LM with backoff."""
     def __init__(self, order, vocab, unk_token='<UNK>', prob={}, backoff={}):
@@ -112,6 +348,12 @@ class LanguageModel:
         self.unk_id = self.vocab2id[unk_token]
         self.prob = prob
         self.backoff = backoff
+        # bits per word id in ngram hashes, and mask keeping order-1 ids
+        self.word_bits = len(self.vocab).bit_length()
+        self.state_mask = (1 << (self.word_bits * (self.order - 1))) - 1
+        self._tables = None
+        # optional Metrics, see Translator.set_metrics
+        self.metrics = None
 
     def logscore(self, *args, **kwargs):
         score = self.score(*args, **kwargs)
@@ -119,35 +361,282 @@ class LanguageModel:
 
     def score(self, word, context=None):
         """Compute the LM probability p(e_i | e_i-1, e_i-2, ...)."""
-        B = len(self.vocab).bit_length()
         ctx_hash = self._ngram_hash(context)
         word_hash = self._ngram_hash(word)
-        ngram_hash = (ctx_hash << B) + word_hash
+        ngram_hash = (ctx_hash << self.word_bits) + word_hash
+        if self.metrics is not None:
+            self.metrics.inc('lm_queries')
+            self.metrics.observe('lm_backoff_depth',
+                self._backoff_depth(ngram_hash), COUNT_BUCKETS)
         return self.backoff_score(ngram_hash)
 
+    def word_id(self, word):
+        return self.vocab2id.get(word, self.unk_id)
+
+    def null_state(self):
+        """Returns the LM state with no context."""
+        return 0
+
+    def begin_state(self):
+        """Returns the LM state at the start of a sentence, after <s>."""
+        return self.vocab2id['<s>']
+
+    def advance(self, state, word):
+        """
+        Score a word after the context packed in state, where word is a
+        string or an id from word_id.
+        returns: (log10 prob, new state)
+        """
+        if not isinstance(word, int):
+            word = self.word_id(word)
+        ngram_hash = (state << self.word_bits) + word
+        if self.metrics is not None:
+            self.metrics.inc('lm_queries')
+            self.metrics.observe('lm_backoff_depth',
+                self._backoff_depth(ngram_hash), COUNT_BUCKETS)
+        score = self.backoff_score(ngram_hash)
+        logscore = math.log(score, 10) if score > 0 else float('-inf')
+        return logscore, ngram_hash & self.state_mask
+
+    def advance_many(self, states, words):
+        """
+        Vectorized advance over arrays of LM states and word ids.
+        returns: (log10 probs, new states)
+        """
+        states = np.asarray(states, dtype=np.uint64)
+        words = np.asarray(words, dtype=np.uint64)
+        scores = self.score_many(states, words)
+        # as in advance, scores <= 0 (from negative backoffs) are -inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logscores = np.where(scores > 0, np.log10(scores), -np.inf)
+        new_states = ((states << np.uint64(self.word_bits)) | words) \
+            & np.uint64(self.state_mask)
+        return logscores, new_states
+
+    def score_many(self, contexts, words):
+        """
+        Vectorized score of p(words[i] | contexts[i]) for all i, following
+        the same backoff chain as backoff_score.
+        contexts: (N, k) array of context word ids left padded with 0, or
+            (N,) array of packed LM states.
+        words: (N,) array of word ids.
+        """
+        prob, backoff = self._ngram_tables()
+        B = np.uint64(self.word_bits)
+        contexts = np.asarray(contexts, dtype=np.uint64)
+        words = np.asarray(words, dtype=np.uint64)
+        if contexts.ndim == 2:
+            states = np.zeros(len(contexts), dtype=np.uint64)
+            for j in range(contexts.shape[1]):
+                states = (states << B) | contexts[:, j]
+            contexts = states & np.uint64(self.state_mask)
+        ngram_hash = (contexts << B) | words
+        result = np.zeros(len(words))
+        weight = np.ones(len(words))
+        done = np.zeros(len(words), dtype=bool)
+        # number of times each query backed off to a lower order
+        depth = np.zeros(len(words), dtype=np.int64)
+        for k in range(self.order, 0, -1):
+            shift = np.uint64(self.word_bits * (k - 1))
+            # ngrams whose highest order is currently k
+            idx = np.flatnonzero(~done & ((ngram_hash >> shift) != 0))
+            if not len(idx):
+                continue
+            found, p = prob.lookup(ngram_hash[idx])
+            result[idx[found]] = weight[idx[found]] * p[found]
+            done[idx[found]] = True
+            miss = idx[~found]
+            depth[miss] += 1
+            bo_found, bo = backoff.lookup(ngram_hash[miss] >> B)
+            weight[miss] *= np.where(bo_found, bo, 1)
+            ngram_hash[miss] &= np.uint64((1 << int(shift)) - 1)
+        result[~done] = weight[~done] * prob.get(0, 0)
+        if self.metrics is not None:
+            self.metrics.inc('lm_queries', len(words))
+            self.metrics.observe_many('lm_backoff_depth', depth)
+        return result
+
+    def _ngram_tables(self):
+        """Returns prob and backoff as NgramTables, converting dicts once."""
+        if self._tables is None:
+            self._tables = [t if isinstance(t, NgramTable)
+                else NgramTable.from_dict(t, dtype=np.float64)
+                for t in [self.prob, self.backoff]]
+        return self._tables
+
     def backoff_score(self, ngram_hash):
-        B = len(self.vocab).bit_length()
+        B = self.word_bits
         ctx_hash = ngram_hash >> B
-        if ngram_hash in self.prob:
-            return self.prob[ngram_hash]
+        prob = self.prob.get(ngram_hash)
+        if prob is not None:
+            return prob
         else:
             backoff_weight = self.backoff.get(ctx_hash, 1)
             backoff_hash = self._ngram_hash_reduced(ngram_hash)
             return backoff_weight * self.backoff_score(backoff_hash)
 
-    def train(self, dataset_files):
-        """Trains an LM given a list of text files."""
+    def _backoff_depth(self, ngram_hash):
+        """Number of lower orders backoff_score falls back to."""
+        depth = 0
+        while ngram_hash and ngram_hash not in self.prob:
+            ngram_hash = self._ngram_hash_reduced(ngram_hash)
+            depth += 1
+        return depth
+
+    def prune(self, threshold):
+        """
+        Entropy-based pruning (Stolcke, 1998). Removes ngrams of order >= 2
+        whose removal increases the relative entropy of the model by less
+        than threshold, highest order first, then renormalizes the backoff
+        weights of the affected contexts.
+        returns: number of pruned ngrams.
+        """
+        B = self.word_bits
+        self.prob = dict(self.prob.items())
+        self.backoff = dict(self.backoff.items())
+        self._tables = None
+        prob = self.prob
+        ngram_order = lambda h: -(h.bit_length() // -B)
+        children = defaultdict(list)
+        for ngram_hash in prob:
+            if ngram_order(ngram_hash) >= 2:
+                children[ngram_hash >> B].append(ngram_hash)
+        marginals = {0: 1}
+
+        def marginal(ctx_hash):
+            """p(h) of a context, by the chain rule."""
+            if ctx_hash not in marginals:
+                marginals[ctx_hash] = marginal(ctx_hash >> B) \
+                    * self.backoff_score(ctx_hash)
+            return marginals[ctx_hash]
+
+        def leftover_mass(ngram_hashes):
+            """(1 - sum p(w|h), 1 - sum p(w|h')) over the seen words w."""
+            return (1 - sum(prob[h] for h in ngram_hashes),
+                1 - sum(self.backoff_score(self._ngram_hash_reduced(h))
+                    for h in ngram_hashes))
+
+        n_pruned = 0
+        pruned_ctxs = set()
+        for n in range(self.order, 1, -1):
+            for ctx_hash in [c for c in children if ngram_order(c) == n - 1]:
+                ngram_hashes = children[ctx_hash]
+                numer, denom = leftover_mass(ngram_hashes)
+                if numer <= 0 or denom <= 0:
+                    continue
+                p_ctx = marginal(ctx_hash)
+                to_prune = []
+                for ngram_hash in ngram_hashes:
+                    # keep ngrams that are contexts of kept higher orders
+                    if ngram_hash in children:
+                        continue
+                    p = prob[ngram_hash]
+                    p_bo = self.backoff_score(
+                        self._ngram_hash_reduced(ngram_hash))
+                    if p <= 0 or p_bo <= 0:
+                        continue
+                    bo = numer / denom
+                    new_bo = (numer + p) / (denom + p_bo)
+                    delta = -p_ctx * (p * (math.log(p_bo) + math.log(new_bo)
+                        - math.log(p)) + numer * (math.log(new_bo)
+                        - math.log(bo)))
+                    if delta < threshold:
+                        to_prune.append(ngram_hash)
+                for ngram_hash in to_prune:
+                    del prob[ngram_hash]
+                if to_prune:
+                    n_pruned += len(to_prune)
+                    pruned_ctxs.add(ctx_hash)
+                    children[ctx_hash] = [h for h in ngram_hashes
+                        if h in prob]
+                    if not children[ctx_hash]:
+                        del children[ctx_hash]
+        # renormalize backoffs of pruned contexts, and of contexts whose
+        # lower order distribution changed, lowest order first
+        affected = set()
+        ctx_hashes = sorted((set(children) | set(self.backoff) | pruned_ctxs)
+            - {0}, key=ngram_order)
+        for ctx_hash in ctx_hashes:
+            if ctx_hash not in pruned_ctxs \
+                    and self._ngram_hash_reduced(ctx_hash) not in affected:
+                continue
+            affected.add(ctx_hash)
+            if ctx_hash not in children:
+                self.backoff.pop(ctx_hash, None)
+                continue
+            numer, denom = leftover_mass(children[ctx_hash])
+            if numer > 0 and denom > 0:
+                self.backoff[ctx_hash] = numer / denom
+        return n_pruned
+
+    def count(self, dataset_files, counts=None, n_workers=1, tmp_dir=None,
+            max_shard_ngrams=10000000):
+        """
+        Counts the ngram hashes of a list of text files, added to counts of
+        previously seen data if given.
+        If n_workers > 1, files are counted in a process pool, each worker
+        spilling sorted runs of at most max_shard_ngrams counts to tmp_dir.
+        The runs are merged into an NgramTable of counts, so that no Python
+        object is created per ngram.
+        returns: Counter, or NgramTable if n_workers > 1
+        """
+        if n_workers > 1:
+            with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+                jobs = [(dataset_file, f'{run_dir}/{i}', max_shard_ngrams)
+                    for i, dataset_file in enumerate(dataset_files)]
+                with multiprocessing.Pool(n_workers, _init_count_worker,
+                        (self.order, self.vocab)) as pool:
+                    run_files = [run_file for run_files in
+                        pool.imap_unordered(_count_shard, jobs)
+                        for run_file in run_files]
+                if counts:
+                    run_files.append(_save_run(f'{run_dir}/counts',
+                        *_count_arrays(counts)))
+                return NgramTable(*merge_count_arrays(run_files))
+        # nltk is slow to import and only needed for training
+        from nltk.lm.preprocessing import padded_everygram_pipeline
         with fileinput.input(files=dataset_files) as f:
             ngrams, _ = padded_everygram_pipeline(self.order,
                 (line.strip().split() for line in f))
-            ngrams = (ngram for line in ngrams for ngram in line)
-            B = len(self.vocab).bit_length()
+            new_counts = Counter(self._ngram_hash(ngram)
+                for line in ngrams for ngram in line)
+        if counts:
+            new_counts.update(dict(counts.items()))
+        return new_counts
+
+    def train(self, dataset_files, counts=None, **kwargs):
+        """
+        Trains an LM given a list of text files. If counts of previously
+        seen data are given, the new counts are added to them so only the
+        new files need to be read. kwargs are passed to count().
+        """
+        self.counts = self.count(dataset_files, counts, **kwargs)
+        B = self.word_bits
+        if isinstance(self.counts, NgramTable):
+            mkn = SortedModifiedKneserNey(B, self.order, len(self.vocab) - 3)
+            mkn.compute_statistics(self.counts)
+            self.counts = mkn.counts
+        else:
             mkn = ModifiedKneserNey(self._ngram_hash,
                 self._ngram_hash_reduced,
                 lambda x: x >> B,
                 len(self.vocab) - 3)
-            mkn.count(ngrams)
-            self.prob, self.backoff = mkn.prob_backoff()
+            mkn.counts = self.counts
+            mkn.compute_statistics()
+        self.prob, self.backoff = mkn.prob_backoff()
+        self._tables = None
+
+    def save_counts(self, path):
+        """Save the raw ngram counts of the last training run."""
+        keys, counts = _count_arrays(self.counts)
+        with open(path, 'wb') as f:
+            np.savez(f, keys=keys, counts=counts)
+
+    @staticmethod
+    def load_counts(path):
+        """returns: NgramTable of ngram counts"""
+        with np.load(path) as data:
+            return NgramTable(*_count_arrays(data))
 
     def _ngram_hash(self, ngram):
         """Returns hash of an ngram"""
@@ -155,18 +644,21 @@ class LanguageModel:
             return 0
         if isinstance(ngram, str):
             ngram = ngram.split()
-        B = len(self.vocab).bit_length()
+        B = self.word_bits
         return sum(self.vocab2id.get(word, self.unk_id) << (B*(len(ngram)-i-1))
             for i, word in enumerate(ngram))
 
     def _ngram_hash_reduced(self, ngram_hash):
         """Returns hash of an ngram with its leftmost word removed."""
-        B = len(self.vocab).bit_length()
+        B = self.word_bits
         ngram_order = -(ngram_hash.bit_length() // -B)
         reduce_mask = (1 << ((ngram_order - 1) * B)) - 1
         return ngram_hash & reduce_mask
 
-    def save(self, path):
+    def save(self, path, quantize_bits=None):
+        if path.endswith('.bin'):
+            self.save_binary(path, quantize_bits)
+            return
         with open(path, 'wb') as f:
             data = {
                 'order': self.order,
@@ -176,11 +668,195 @@ class LanguageModel:
             }
             pickle.dump(data, f)
 
+    def save_binary(self, path, quantize_bits=None):
+        """
+        Save in the binary format read by load_binary:
+        header, newline separated vocab, then prob keys/log10 values and
+        backoff keys/log10 values as flat arrays, each 8 byte aligned.
+        If quantize_bits is 8 or 16, each table's values are instead stored
+        as a codebook length, a float32 codebook and uint8/uint16 codes.
+        """
+        B = self.word_bits
+        assert B * self.order <= 64, 'ngram hashes do not fit in 64 bits'
+        vocab_bytes = '\n'.join(w or '' for w in self.vocab).encode('utf-8')
+        tables = [self.prob, self.backoff]
+        tables = [t.to_log() if isinstance(t, NgramTable)
+            and t.codebook is None
+            else NgramTable.from_dict(dict(t.items()), log_values=True)
+            for t in tables]
+        if quantize_bits:
+            tables = [t.quantize(quantize_bits) for t in tables]
+            header = QUANTIZED_HEADER.pack(QUANTIZED_MAGIC, self.order,
+                len(vocab_bytes), len(tables[0]), len(tables[1]),
+                quantize_bits)
+        else:
+            header = BINARY_HEADER.pack(BINARY_MAGIC, self.order,
+                len(vocab_bytes), len(tables[0]), len(tables[1]))
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(vocab_bytes)
+            for table in tables:
+                arrays = [table.keys, table.values]
+                if quantize_bits:
+                    arrays = [table.keys,
+                        np.array([len(table.codebook)], dtype=np.uint64),
+                        table.codebook, table.values]
+                for array in arrays:
+                    f.write(b'\0' * (-f.tell() % 8))
+                    f.write(np.ascontiguousarray(array).tobytes())
+
+    @classmethod
+    def load_binary(cls, path):
+        """Load a binary LM, memory mapping its tables."""
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(QUANTIZED_MAGIC)] == QUANTIZED_MAGIC:
+            magic, order, vocab_len, n_prob, n_backoff, quantize_bits = \
+                QUANTIZED_HEADER.unpack_from(mm)
+            offset = QUANTIZED_HEADER.size
+        else:
+            magic, order, vocab_len, n_prob, n_backoff = \
+                BINARY_HEADER.unpack_from(mm)
+            offset = BINARY_HEADER.size
+            quantize_bits = None
+        vocab = mm[offset:offset+vocab_len].decode('utf-8').split('\n')
+        vocab[0] = None
+        offset += vocab_len
+        code_dtype = np.uint8 if quantize_bits == 8 else np.uint16
+
+        def read_array(dtype, count):
+            nonlocal offset
+            offset += -offset % 8
+            array = np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array
+
+        tables = []
+        for n in [n_prob, n_backoff]:
+            keys = read_array(np.uint64, n)
+            if quantize_bits:
+                n_codebook = int(read_array(np.uint64, 1)[0])
+                codebook = read_array(np.float32, n_codebook)
+                values = read_array(code_dtype, n)
+                tables.append(NgramTable(keys, values, True, codebook))
+            else:
+                values = read_array(np.float32, n)
+                tables.append(NgramTable(keys, values, log_values=True))
+        return cls(order, vocab, prob=tables[0], backoff=tables[1])
+
     @classmethod
     def load(cls, path):
         with open(path, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) in [BINARY_MAGIC, QUANTIZED_MAGIC]:
+                return cls.load_binary(path)
+            f.seek(0)
             return cls(**pickle.load(f))
 
+_worker_lm = None
+
+def _init_count_worker(order, vocab):
+    global _worker_lm
+    _worker_lm = LanguageModel(order, vocab)
+
+def _count_shard(job):
+    """
+    Count the ngram hashes of one file, spilling sorted runs to disk
+    whenever max_ngrams distinct ngrams are held in memory.
+    returns: list of run file prefixes.
+    """
+    dataset_file, run_prefix, max_ngrams = job
+    run_files = []
+    counts = Counter()
+
+    def spill():
+        run_files.append(_save_run(f'{run_prefix}_{len(run_files)}',
+            *_count_arrays(counts)))
+        counts.clear()
+
+    from nltk.lm.preprocessing import padded_everygram_pipeline
+    with open(dataset_file, 'r', encoding='utf-8') as f:
+        ngrams, _ = padded_everygram_pipeline(_worker_lm.order,
+            (line.strip().split() for line in f))
+        for line in ngrams:
+            counts.update(_worker_lm._ngram_hash(ngram) for ngram in line)
+            if len(counts) >= max_ngrams:
+                spill()
+    if counts:
+        spill()
+    return run_files
+
+def _count_arrays(counts):
+    """
+    Sorted uint64 key and count arrays of a Counter, an NgramTable or
+    arrays saved by save_counts.
+    """
+    if isinstance(counts, NgramTable):
+        return counts.keys, counts.values.astype(np.uint64)
+    if isinstance(counts, Counter):
+        keys = np.fromiter(counts, dtype=np.uint64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.uint64,
+            count=len(counts))
+    else:
+        keys, values = counts['keys'], counts['counts']
+    order = np.argsort(keys, kind='stable')
+    return keys[order], values[order].astype(np.uint64)
+
+def _save_run(run_file, keys, counts):
+    np.save(f'{run_file}.keys.npy', keys)
+    np.save(f'{run_file}.counts.npy', counts)
+    return run_file
+
+def _iter_run(run_file, block_size=65536):
+    keys = np.load(f'{run_file}.keys.npy', mmap_mode='r')
+    counts = np.load(f'{run_file}.counts.npy', mmap_mode='r')
+    for i in range(0, len(keys), block_size):
+        yield from zip(keys[i:i+block_size].tolist(),
+            counts[i:i+block_size].tolist())
+
+def merge_counts(run_files):
+    """
+    Merge sorted runs of ngram counts, summing counts of equal ngrams.
+    yields: (ngram hash, count) in sorted order.
+    """
+    key = None
+    total = 0
+    for k, c in heapq.merge(*(_iter_run(f) for f in run_files)):
+        if k != key:
+            if key is not None:
+                yield key, total
+            key = k
+            total = 0
+        total += c
+    if key is not None:
+        yield key, total
+
+def merge_count_arrays(run_files, block_size=65536):
+    """
+    Merge sorted runs of ngram counts into sorted uint64 key and count
+    arrays, filled block by block as the merge streams.
+    """
+    size = sum(len(np.load(f'{run_file}.keys.npy', mmap_mode='r'))
+        for run_file in run_files)
+    keys = np.empty(size, dtype=np.uint64)
+    counts = np.empty(size, dtype=np.uint64)
+    n = 0
+    block_keys = []
+    block_counts = []
+    for key, count in merge_counts(run_files):
+        block_keys.append(key)
+        block_counts.append(count)
+        if len(block_keys) >= block_size:
+            keys[n:n+len(block_keys)] = block_keys
+            counts[n:n+len(block_keys)] = block_counts
+            n += len(block_keys)
+            block_keys.clear()
+            block_counts.clear()
+    keys[n:n+len(block_keys)] = block_keys
+    counts[n:n+len(block_keys)] = block_counts
+    n += len(block_keys)
+    # equal ngrams of different runs were summed, so fewer may remain
+    return keys[:n].copy(), counts[:n].copy()
+
 def debug(args):
     lm = LanguageModel.load(args.lm_file)
     while True:
@@ -189,9 +865,41 @@ def debug(args):
         context = tokens[-lm.order:-1]
         print(lm.logscore(word, context))
 
+def convert(args):
+    lm = LanguageModel.load(args.lm_file)
+    lm.save(args.output_file, quantize_bits=args.quantize_bits)
+    print('Saved to', args.output_file)
+
+def prune(args):
+    lm = LanguageModel.load(args.lm_file)
+    n_ngrams = len(lm.prob)
+    n_pruned = lm.prune(args.threshold)
+    print(f'Pruned {n_pruned}/{n_ngrams} ngrams')
+    lm.save(args.output_file, quantize_bits=args.quantize_bits)
+    print('Saved to', args.output_file)
+
+def counts_file_for(lm_file):
+    return os.path.splitext(lm_file)[0] + '.counts.npz'
+
 def train(args):
     dataset_files = glob.glob(args.dataset_files_pattern, recursive=True)
     lm = LanguageModel(order=args.order, vocab=args.vocab_dir)
-    lm.train(dataset_files)
+    lm.train(dataset_files, n_workers=args.n_workers, tmp_dir=args.tmp_dir,
+        max_shard_ngrams=args.max_shard_ngrams)
     lm.save(args.lm_file)
     print('Saved to', args.lm_file)
+    counts_file = args.counts_file or counts_file_for(args.lm_file)
+    lm.save_counts(counts_file)
+    print('Saved counts to', counts_file)
+
+def update(args):
+    dataset_files = glob.glob(args.dataset_files_pattern, recursive=True)
+    counts_file = args.counts_file or counts_file_for(args.lm_file)
+    lm = LanguageModel.load(args.lm_file)
+    counts = lm.load_counts(counts_file)
+    lm.train(dataset_files, counts=counts, n_workers=args.n_workers,
+        tmp_dir=args.tmp_dir, max_shard_ngrams=args.max_shard_ngrams)
+    lm.save(args.lm_file)
+    lm.save_counts(counts_file)
+    print(f'Updated {args.lm_file} and {counts_file} '
+        f'with {len(dataset_files)} files')
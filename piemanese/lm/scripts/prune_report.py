@@ -0,0 +1,34 @@
+import argparse
+import os
+import time
+from piemanese.lm import LanguageModel
+from piemanese.test import read_benchmark, evaluate
+from piemanese.translator import Translator
+
+def main(args):
+    pi_lines, en_lines = read_benchmark(args.benchmark_dir)
+    words = sum(len(line.split()) for line in en_lines)
+    print('\t'.join(['lm_file', 'ngrams', 'size_mb', 'load_s', 'wer', 'ser']))
+    for lm_file in args.lm_files:
+        start = time.perf_counter()
+        lm = LanguageModel.load(lm_file)
+        load_time = time.perf_counter() - start
+        translator = Translator(lm_file=lm_file, tm_file=args.tm_file)
+        _, errors, _, _ = evaluate(translator, pi_lines, en_lines,
+            progress=False)
+        print('\t'.join([
+            lm_file,
+            str(len(lm.prob)),
+            f'{os.path.getsize(lm_file) / 2**20:.2f}',
+            f'{load_time:.3f}',
+            f'{sum(errors) / words * 100:.2f}%',
+            f'{sum(1 for e in errors if e) / len(errors) * 100:.2f}%']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('lm_files', nargs='+')
+    parser.add_argument('--tm_file', default='tm.pkl')
+    parser.add_argument('--benchmark_dir')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,100 @@
+import re
+
+class PhraseMatcher:
+    """
+    Applies many phrase replacement rules to a sentence. Literal rules are
+    compiled into a token trie and applied in a single left to right pass,
+    replacing the longest matching phrase at each position, so the cost
+    does not grow with the number of rules. Rules that are real regexes
+    are applied afterwards, in order.
+    """
+    def __init__(self, rules):
+        """rules: [(pattern, replacement)] with regex patterns."""
+        self.trie = {}
+        self.regex_rules = []
+        self.punc_re = re.compile(r'^(.*?)([?.!,]*)$')
+        for pattern, repl in rules:
+            if re.escape(pattern).replace('\\ ', ' ') == pattern \
+                    and pattern.split():
+                self._add(pattern.split(), repl.split())
+            else:
+                self.regex_rules.append((re.compile(pattern), repl))
+
+    def _add(self, tokens, repl_tokens):
+        node = self.trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        # first rule wins, as it would have been applied first
+        node.setdefault(None, repl_tokens)
+
+    def _split_punctuation(self, token):
+        """Splits a token into word, trailing punctuation"""
+        match = self.punc_re.match(token)
+        return match.group(1), match.group(2)
+
+    def _longest_match(self, words, puncs, i):
+        """
+        returns: (end, replacement) of the longest phrase at i, or None.
+        Phrases cannot span punctuation, except after their last word.
+        """
+        node = self.trie
+        match = None
+        for j in range(i, len(words)):
+            node = node.get(words[j])
+            if node is None:
+                break
+            if None in node:
+                match = (j + 1, node[None])
+            if puncs[j]:
+                break
+        return match
+
+    def sub(self, tokens):
+        """Replace phrases in a list of tokens. returns: sentence string"""
+        words, puncs = zip(*map(self._split_punctuation, tokens)) \
+            if tokens else ((), ())
+        out = []
+        i = 0
+        while i < len(tokens):
+            match = self._longest_match(words, puncs, i) \
+                if words[i] in self.trie else None
+            if match is None:
+                out.append(tokens[i])
+                i += 1
+                continue
+            i, repl_tokens = match
+            out += repl_tokens
+            # keep the punctuation of the phrase's last word
+            if puncs[i - 1]:
+                if out:
+                    out[-1] += puncs[i - 1]
+                else:
+                    out.append(puncs[i - 1])
+        sent = ' '.join(out)
+        for phrase_re, repl in self.regex_rules:
+            sent = phrase_re.sub(repl, sent)
+        return sent
+
+class TokenClassifier:
+    """
+    Decides whether tokens belong to a class given by a set of words, which
+    tokens are compared to after collapsing repeated characters, or by a
+    regex. Decisions are memoized, so each distinct token is only
+    classified once.
+    """
+    def __init__(self, words, token_re=None, max_cache_size=100000):
+        self.repeat_re = re.compile(r'(.)\1+')
+        self.words = set(words)
+        self.token_re = token_re
+        self.max_cache_size = max_cache_size
+        self.cache = {}
+
+    def __call__(self, token):
+        result = self.cache.get(token)
+        if result is None:
+            result = self.repeat_re.sub(r'\1', token) in self.words \
+                or bool(self.token_re and self.token_re.match(token))
+            if len(self.cache) >= self.max_cache_size:
+                self.cache.clear()
+            self.cache[token] = result
+        return result
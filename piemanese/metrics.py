@@ -0,0 +1,164 @@
+import sys
+import time
+import bisect
+import resource
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+class StageTimer:
+    """
+    Accumulates seconds spent per named stage. Stages can be nested, in
+    which case time spent in an inner stage is not counted in the outer one.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self.stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] += elapsed - self.stack.pop()
+            self.calls[name] += 1
+            if self.stack:
+                self.stack[-1] += elapsed
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+
+def timed(timer, name):
+    """Times a stage if timer is set, otherwise does nothing."""
+    return timer.stage(name) if timer is not None else nullcontext()
+
+def percentile(values, q):
+    """q-th percentile of values, by linear interpolation."""
+    values = sorted(values)
+    if not values:
+        return 0
+    k = (len(values) - 1) * q / 100
+    i = int(k)
+    j = min(i + 1, len(values) - 1)
+    return values[i] + (values[j] - values[i]) * (k - i)
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+    2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class Histogram:
+    """Counts of observed values per upper bound, as in Prometheus."""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = np.zeros(len(self.buckets) + 1, dtype=np.int64)
+        self.sum = 0.0
+        self.max = float('-inf')
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def observe_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        self.counts += np.bincount(np.searchsorted(self.buckets, values),
+            minlength=len(self.counts))
+        self.sum += float(values.sum())
+        self.max = max(self.max, float(values.max()))
+
+class Metrics(StageTimer):
+    """
+    Opt-in instrumentation of the translation pipeline: stage timings,
+    counters, histograms and gauges, readable with snapshot() or as
+    Prometheus text. Components only record into it when it is attached
+    with Translator.set_metrics, so it costs nothing otherwise.
+    """
+    def __init__(self, prefix='piemanese'):
+        super().__init__()
+        self.prefix = prefix
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        # functions returning {name: value}, evaluated on read
+        self.gauge_fns = []
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def _histogram(self, name, buckets):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(buckets)
+        return self.histograms[name]
+
+    def observe(self, name, value, buckets=TIME_BUCKETS):
+        self._histogram(name, buckets).observe(value)
+
+    def observe_many(self, name, values, buckets=COUNT_BUCKETS):
+        self._histogram(name, buckets).observe_many(values)
+
+    def add_gauges(self, fn):
+        self.gauge_fns.append(fn)
+
+    def gauges(self):
+        return {name: value for fn in self.gauge_fns
+            for name, value in fn().items()}
+
+    def reset(self):
+        super().reset()
+        self.counters.clear()
+        self.histograms.clear()
+
+    def snapshot(self):
+        return {
+            'stages': {name: {'seconds': seconds, 'calls': self.calls[name]}
+                for name, seconds in self.seconds.items()},
+            'counters': dict(self.counters),
+            'histograms': {name: {
+                    'count': h.count,
+                    'sum': h.sum,
+                    'mean': h.sum / h.count if h.count else 0,
+                    'max': h.max if h.count else 0
+                } for name, h in self.histograms.items()},
+            'gauges': self.gauges()
+        }
+
+    def to_prometheus(self):
+        """Metrics in the Prometheus text exposition format."""
+        p = self.prefix
+        lines = []
+        for name, values in [('stage_seconds_total', self.seconds),
+                ('stage_calls_total', self.calls)]:
+            if values:
+                lines.append(f'# TYPE {p}_{name} counter')
+                lines += [f'{p}_{name}{{stage="{stage}"}} {value}'
+                    for stage, value in sorted(values.items())]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE {p}_{name}_total counter')
+            lines.append(f'{p}_{name}_total {value}')
+        for name, h in sorted(self.histograms.items()):
+            lines.append(f'# TYPE {p}_{name} histogram')
+            cumulative = np.cumsum(h.counts).tolist()
+            for bound, count in zip(h.buckets + ('+Inf',), cumulative):
+                lines.append(f'{p}_{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f'{p}_{name}_sum {h.sum}')
+            lines.append(f'{p}_{name}_count {h.count}')
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f'# TYPE {p}_{name} gauge')
+            lines.append(f'{p}_{name} {value}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,189 @@
+import json
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+MAX_BODY_SIZE = 1 << 20
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large',
+    500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+class TranslationServer:
+    """
+    Minimal HTTP/JSON server around an AsyncTranslator, so that several bot
+    processes can share one copy of the models.
+
+    POST /translate {"text": str} -> {"translation": str}
+    POST /translate {"texts": [str]} -> {"translations": [str]}
+    GET /health -> {"status": "ok", ...}
+    GET /metrics -> Prometheus text
+    Responds 503 if the translation queue is full.
+    """
+    def __init__(self, async_translator):
+        self.async_translator = async_translator
+
+    async def handle(self, reader, writer):
+        try:
+            status, payload = await self._handle_request(reader)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {'error': str(e)}
+        if isinstance(payload, str):
+            body = payload.encode()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            body = json.dumps(payload).encode()
+            content_type = 'application/json'
+        writer.write((f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n').encode() + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def _handle_request(self, reader):
+        method, path, _ = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        content_length = int(headers.get('content-length', 0))
+        if content_length > MAX_BODY_SIZE:
+            return 413, {'error': 'request body too large'}
+        body = await reader.readexactly(content_length)
+
+        if path == '/health':
+            if method != 'GET':
+                return 405, {'error': f'{method} not allowed'}
+            return 200, self.health()
+        if path == '/metrics':
+            if method != 'GET':
+                return 405, {'error': f'{method} not allowed'}
+            # on the translation thread, so metrics are not read mid-update
+            return 200, await asyncio.get_running_loop().run_in_executor(
+                self.async_translator.executor,
+                self.async_translator.translator.metrics.to_prometheus)
+        if path == '/translate':
+            if method != 'POST':
+                return 405, {'error': f'{method} not allowed'}
+            return await self.translate(json.loads(body or b'{}'))
+        return 404, {'error': f'{path} not found'}
+
+    async def translate(self, request):
+        if not isinstance(request, dict):
+            return 400, {'error': 'expected a json object'}
+        texts = request.get('texts', [request.get('text')])
+        if not isinstance(texts, list) or not texts \
+                or not all(isinstance(text, str) for text in texts):
+            return 400, {'error': 'expected "text" as a string or "texts" '
+                'as a list of strings'}
+        try:
+            en_sents = await asyncio.gather(*[
+                self.async_translator.translate(text) for text in texts])
+        except asyncio.QueueFull:
+            return 503, {'error': 'translation queue full'}
+        except Exception as e:
+            return 500, {'error': repr(e)}
+        if 'texts' in request:
+            return 200, {'translations': en_sents}
+        return 200, {'translation': en_sents[0]}
+
+    def health(self):
+        return {
+            'status': 'ok',
+            'startup': self.async_translator.translator.startup_stats(),
+            'batching': self.async_translator.stats(),
+            'tm_cache': self.async_translator.translator.decoder.tm.cache_stats()
+        }
+
+class TranslatorClient:
+    """
+    Async client for a TranslationServer, with the same translate interface
+    as AsyncTranslator. Does not import any of the models.
+    """
+    def __init__(self, url='http://127.0.0.1:8080', timeout=30):
+        url = urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+
+    async def request(self, method, path, payload=None):
+        """returns: (status, response json)"""
+        body = json.dumps(payload).encode() if payload is not None else b''
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        try:
+            writer.write((f'{method} {path} HTTP/1.1\r\n'
+                f'Host: {self.host}:{self.port}\r\n'
+                'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n').encode() + body)
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), self.timeout)
+        finally:
+            writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        status = int(head.split(None, 2)[1])
+        return status, json.loads(body)
+
+    async def translate(self, pi_sent):
+        """Raises asyncio.QueueFull if the server is overloaded."""
+        status, response = await self.request('POST', '/translate',
+            {'text': pi_sent})
+        if status == 503:
+            raise asyncio.QueueFull(response['error'])
+        if status != 200:
+            raise RuntimeError(f'Translation server error {status}: '
+                f'{response["error"]}')
+        return response['translation']
+
+    async def health(self):
+        return (await self.request('GET', '/health'))[1]
+
+async def serve(args):
+    # only the server process loads the models
+    from .translator import Translator
+    from .async_translator import AsyncTranslator
+
+    translator = Translator(lm_file=args.lm_file, tm_file=args.tm_file,
+        tm_cache_file=args.tm_cache_file, decoder_mode=args.decoder_mode,
+        warm_up=True)
+    translator.enable_metrics()
+    async_translator = AsyncTranslator(translator,
+        max_batch_size=args.max_batch_size, max_delay=args.max_delay,
+        max_queue_size=args.max_queue_size)
+    server = await asyncio.start_server(
+        TranslationServer(async_translator).handle, args.host, args.port)
+    print(f'Serving on http://{args.host}:{args.port}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        async_translator.close()
+        translator.save_cache()
+
+def main(args):
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--lm_file', default='lm.pkl')
+    parser.add_argument('--tm_file', default='tm.pkl')
+    parser.add_argument('--tm_cache_file')
+    parser.add_argument('--decoder_mode', default='beam', choices=['beam', 'viterbi'])
+    parser.add_argument('--max_batch_size', default=64, type=int)
+    parser.add_argument('--max_delay', default=0.005, type=float)
+    parser.add_argument('--max_queue_size', default=256, type=int)
+    args = parser.parse_args()
+
+    main(args)
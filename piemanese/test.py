@@ -1,45 +1,274 @@
 import argparse
 import os.path
+import time
+import json
+import random
+from contextlib import nullcontext
 from difflib import SequenceMatcher
 from tqdm import tqdm
+from . import translator as translator_module
 from .translator import Translator
+from .metrics import Metrics, percentile, peak_rss_mb
+from .translate import translate_chunks, translator_pool
 
-def main(args):
-    if not args.benchmark_dir:
-        args.benchmark_dir = f'{os.path.dirname(__file__)}/benchmark'
-    with open(args.benchmark_dir + '/pi.txt', 'r', encoding='utf-8') as f:
+def read_benchmark(benchmark_dir=None):
+    if not benchmark_dir:
+        benchmark_dir = f'{os.path.dirname(__file__)}/benchmark'
+    with open(benchmark_dir + '/pi.txt', 'r', encoding='utf-8') as f:
         pi_lines = [line.strip() for line in f.readlines()]
-    with open(args.benchmark_dir + '/en.txt', 'r', encoding='utf-8') as f:
+    with open(benchmark_dir + '/en.txt', 'r', encoding='utf-8') as f:
         en_lines = [line.strip() for line in f.readlines()]
-    translator = Translator()
-    words = 0
-    words_err = 0
+    return pi_lines, en_lines
+
+def count_errors(en_pred, en_true):
+    """Number of word errors between a predicted and true sentence."""
+    s = SequenceMatcher(None, en_pred.split(), en_true.split())
+    return sum(
+        max(i2 - i1, j2 - j1)
+        for tag, i1, i2, j1, j2 in s.get_opcodes()
+        if tag != 'equal')
+
+def evaluate(translator, pi_lines, en_lines, batch_size=64, verbose=0,
+        progress=True):
+    """
+    Translate benchmark sentences in batches.
+    returns: (en_preds, errors per sentence, seconds spent translating,
+        decoder search stats per sentence)
+    """
+    start = time.perf_counter()
+    en_preds = []
+    search_stats = []
+    batches = range(0, len(pi_lines), batch_size)
+    for i in tqdm(batches, disable=not progress):
+        en_preds += translator.translate_batch(pi_lines[i:i+batch_size],
+            batch_size=batch_size, verbose=verbose)
+        search_stats += translator.decoder.search_stats
+    elapsed = time.perf_counter() - start
+    errors = [count_errors(en_pred, en_true)
+        for en_pred, en_true in zip(en_preds, en_lines)]
+    return en_preds, errors, elapsed, search_stats
+
+def benchmark(args, pi_lines):
+    """
+    Measure cold start, per sentence latency (one sentence per call),
+    batched throughput, time per stage and peak RSS. The TM cache is
+    cleared before each pass, so no pass benefits from an earlier one.
+    """
+    start = time.perf_counter()
+    translator = Translator(lm_file=args.lm_file, tm_file=args.tm_file,
+        decoder_mode=args.decoder_mode)
+    init_seconds = time.perf_counter() - start
+    first_start = time.perf_counter()
+    translator(pi_lines[0])
+    first_seconds = time.perf_counter() - first_start
+    cold_start = {
+        'seconds': translator_module.IMPORT_SECONDS + init_seconds
+            + first_seconds,
+        **translator.startup_stats(),
+        'first_sentence': first_seconds
+    }
+
+    tm = translator.decoder.tm
+    metrics = translator.set_metrics(Metrics())
+    tm.cache.clear()
+    latencies = []
+    for pi_line in tqdm(pi_lines, disable=args.verbose > 0):
+        start = time.perf_counter()
+        translator(pi_line)
+        latencies.append(time.perf_counter() - start)
+    translator.set_metrics(None)
+
+    tm.cache.clear()
+    start = time.perf_counter()
+    translator.translate_batch(pi_lines, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+
+    n = len(pi_lines)
+    return {
+        'n_sentences': n,
+        'config': {
+            'lm_file': args.lm_file,
+            'tm_file': args.tm_file,
+            'decoder_mode': args.decoder_mode,
+            'batch_size': args.batch_size
+        },
+        'cold_start_s': cold_start,
+        'latency_ms': {
+            'mean': sum(latencies) / n * 1000,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': max(latencies) * 1000
+        },
+        'stage_ms_per_sentence': {stage: seconds / n * 1000
+            for stage, seconds in sorted(metrics.seconds.items())},
+        'throughput': {'sentences_per_s': n / elapsed},
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def compare(results, baseline, tolerance=0.2, min_delta=1e-3):
+    """
+    Compare benchmark results to a baseline. Throughput is better when
+    higher, every other metric when lower. Changes smaller than min_delta,
+    in the unit of the metric, are treated as noise.
+    returns: [(metric, baseline value, value, relative change, regressed)]
+    """
+    results, baseline = _flatten(results), _flatten(baseline)
+    rows = []
+    for metric, value in results.items():
+        if metric not in baseline or metric == 'n_sentences' \
+                or metric.startswith('config.'):
+            continue
+        base = baseline[metric]
+        change = (value - base) / base if base else 0
+        if abs(value - base) < min_delta:
+            regressed = False
+        elif metric.startswith('throughput.'):
+            regressed = change < -tolerance
+        else:
+            regressed = change > tolerance
+        rows.append((metric, base, value, change, regressed))
+    return rows
+
+def perf(args):
+    pi_lines, _ = read_benchmark(args.benchmark_dir[0]
+        if args.benchmark_dir else None)
+    results = benchmark(args, pi_lines)
+    print(json.dumps(results, indent=2))
+    if args.perf_file:
+        with open(args.perf_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved to', args.perf_file)
+    if not args.baseline_file:
+        return
+    with open(args.baseline_file, 'r') as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.tolerance)
+    print('\t'.join(['metric', 'baseline', 'current', 'change', '']))
+    for metric, base, value, change, regressed in rows:
+        print('\t'.join([metric, f'{base:.4g}', f'{value:.4g}',
+            f'{change*100:+.1f}%', 'REGRESSION' if regressed else '']))
+    n_regressed = sum(row[-1] for row in rows)
+    if n_regressed:
+        raise SystemExit(f'{n_regressed} metrics regressed by more than '
+            f'{args.tolerance*100:.0f}%')
+
+def sample_benchmark(pi_lines, en_lines, n, seed=0):
+    """Seeded random subset of n sentence pairs, kept in benchmark order."""
+    if not n or n >= len(pi_lines):
+        return pi_lines, en_lines
+    idx = sorted(random.Random(seed).sample(range(len(pi_lines)), n))
+    return [pi_lines[i] for i in idx], [en_lines[i] for i in idx]
+
+def _evaluate_chunk(translator, pairs, batch_size):
+    pi_lines, en_lines = zip(*pairs)
+    en_preds, errors, _, search_stats = evaluate(translator, list(pi_lines),
+        list(en_lines), batch_size, progress=False)
+    return en_preds, errors, search_stats
+
+def evaluate_parallel(translator_kwargs, pi_lines, en_lines, n_workers,
+        batch_size=64, chunk_size=None, pool=None):
+    """
+    evaluate() split across n_workers processes that each load the models
+    once. Results are merged in benchmark order. The time returned
+    includes starting the workers, unless an existing translator_pool is
+    given.
+    """
+    chunk_size = chunk_size or -(-len(pi_lines) // (2 * n_workers))
+    pairs = list(zip(pi_lines, en_lines))
+    chunks = [pairs[i:i+chunk_size] for i in range(0, len(pairs), chunk_size)]
+    start = time.perf_counter()
+    en_preds, errors, search_stats = [], [], []
+    for chunk_preds, chunk_errors, chunk_stats in tqdm(translate_chunks(
+            chunks, translator_kwargs, n_workers, batch_size,
+            chunk_fn=_evaluate_chunk, pool=pool), total=len(chunks)):
+        en_preds += chunk_preds
+        errors += chunk_errors
+        search_stats += chunk_stats
+    return en_preds, errors, time.perf_counter() - start, search_stats
+
+def report(args, pi_lines, en_lines, en_preds, errors, elapsed, search_stats):
+    words = sum(len(en_true.split()) for en_true in en_lines)
+    words_err = sum(errors)
     sents = len(en_lines)
-    sents_err = 0
+    sents_err = sum(1 for e in errors if e)
     print('\t'.join(['pi', 'en_true', 'en_pred', 'errors']))
-    for pi, en_true in tqdm(list(zip(pi_lines, en_lines))):
-        en_pred = translator(pi, verbose=args.verbose)
-        en_pred_words = en_pred.split()
-        en_true_words = en_true.split()
-        words += len(en_true_words)
-        s = SequenceMatcher(None, en_pred_words, en_true_words)
-        errors = sum(
-            max(i2 - i1, j2 - j1)
-            for tag, i1, i2, j1, j2 in s.get_opcodes()
-            if tag != 'equal')
-        if errors:
-            words_err += errors
-            sents_err += 1
-        if not args.errors_only or errors:
-            print('\t'.join([pi, en_true, en_pred, str(errors)]))
+    for pi, en_true, en_pred, e in zip(pi_lines, en_lines, en_preds, errors):
+        if not args.errors_only or e:
+            print('\t'.join([pi, en_true, en_pred, str(e)]))
     print(f'WER: {words_err}/{words} ({words_err/words*100}%)')
     print(f'SER: {sents_err}/{sents} ({sents_err/sents*100}%)')
+    print(f'Throughput: {len(pi_lines)/elapsed:.2f} sentences/s')
+    for key in ['states', 'transitions', 'seconds']:
+        values = [stats[key] for stats in search_stats]
+        print(f'Search {key}: mean {sum(values)/len(values):.4g}, '
+            f'max {max(values):.4g}')
+    return words_err, words, sents_err, sents
+
+def main(args):
+    if args.perf:
+        perf(args)
+        return
+    translator_kwargs = {
+        'lm_file': args.lm_file,
+        'tm_file': args.tm_file,
+        'decoder_mode': args.decoder_mode
+    }
+    if args.n_workers <= 1:
+        translator = Translator(**translator_kwargs)
+    benchmark_dirs = args.benchmark_dir or [None]
+    totals = [0, 0, 0, 0]
+    # one pool for all benchmarks, so each worker loads the models once
+    with translator_pool(translator_kwargs, args.n_workers) \
+            if args.n_workers > 1 else nullcontext() as pool:
+        for benchmark_dir in benchmark_dirs:
+            pi_lines, en_lines = sample_benchmark(
+                *read_benchmark(benchmark_dir), args.subset, args.seed)
+            if len(benchmark_dirs) > 1:
+                print(f'# {benchmark_dir}')
+            if pool is not None:
+                results = evaluate_parallel(translator_kwargs, pi_lines,
+                    en_lines, args.n_workers, args.batch_size,
+                    args.chunk_size, pool)
+            else:
+                results = evaluate(translator, pi_lines, en_lines,
+                    args.batch_size, args.verbose)
+            counts = report(args, pi_lines, en_lines, *results)
+            totals = [total + count for total, count in zip(totals, counts)]
+    if len(benchmark_dirs) > 1:
+        words_err, words, sents_err, sents = totals
+        print('# total')
+        print(f'WER: {words_err}/{words} ({words_err/words*100}%)')
+        print(f'SER: {sents_err}/{sents} ({sents_err/sents*100}%)')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-b', '--benchmark_dir')
+    parser.add_argument('-b', '--benchmark_dir', nargs='+', help='Benchmark directories, each with pi.txt and en.txt')
     parser.add_argument('-e', '--errors_only', action='store_true')
     parser.add_argument('-v', '--verbose', default=0, type=int, choices=[0,1,2])
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--lm_file', default='lm.pkl')
+    parser.add_argument('--tm_file', default='tm.pkl')
+    parser.add_argument('--decoder_mode', default='beam', choices=['beam', 'viterbi'])
+    parser.add_argument('-n', '--n_workers', default=1, type=int, help='Number of worker processes')
+    parser.add_argument('--chunk_size', type=int, help='Sentences per worker task (default: 2 tasks per worker)')
+    parser.add_argument('--subset', type=int, help='Evaluate a random subset of this many sentences per benchmark')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed of --subset')
+    parser.add_argument('--perf', action='store_true', help='Run the performance benchmark instead of WER/SER')
+    parser.add_argument('--perf_file', help='Save performance results to this JSON file')
+    parser.add_argument('--baseline_file', help='Performance results JSON to compare against')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='Relative change flagged as a regression')
     args = parser.parse_args()
+    if args.verbose and args.n_workers > 1:
+        parser.error('-v/--verbose is only supported with -n 1')
 
     main(args)
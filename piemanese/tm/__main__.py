@@ -1,5 +1,6 @@
 import argparse
-from .tm import train, debug
+import os.path
+from .tm import train, debug, recall, precompute, export, compare_backends
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -8,12 +9,46 @@ if __name__ == '__main__':
 
     train_parser = subparsers.add_parser('train')
     train_parser.add_argument('--tm_file', default='tm.pkl', help='Name of TM file')
+    train_parser.add_argument('--backend', default='tf', choices=['tf', 'numpy'], help='NN inference backend')
+    train_parser.add_argument('--numpy_model_file', help='Weights exported by the export command, for the numpy backend')
     train_parser.set_defaults(fn=train)
 
     debug_parser = subparsers.add_parser('debug')
     debug_parser.add_argument('--tm_file', default='tm.pkl', help='Name of TM file')
     debug_parser.set_defaults(fn=debug)
 
+    recall_parser = subparsers.add_parser('recall', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    tm_dir = os.path.dirname(__file__)
+    recall_parser.add_argument('--word_pairs_file', default=f'{tm_dir}/datasets/word_pairs/true/benchmark.tsv', help='TSV of true (pi, en) word pairs')
+    recall_parser.add_argument('--vocab_dir', default=f'{tm_dir}/../vocab', help='Path to vocab directory')
+    recall_parser.add_argument('-k', nargs='+', default=[50, 100, 200, 500, 0], type=int, help='Shortlist sizes to report (0 for no limit)')
+    recall_parser.set_defaults(fn=recall)
+
+    precompute_parser = subparsers.add_parser('precompute', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    precompute_parser.add_argument('--tm_file', default='tm.pkl', help='Name of TM file')
+    precompute_parser.add_argument('--freq_file', default=f'{tm_dir}/datasets/piemanese/freq.txt', help='Piemanese word frequencies from scripts/get_replacements.py')
+    precompute_parser.add_argument('--n_words', default=5000, type=int, help='Number of most frequent words to precompute')
+    precompute_parser.add_argument('--top_k', default=10, type=int, help='Number of English candidates to store per word')
+    precompute_parser.add_argument('--n_candidates', default=200, type=int, help='Shortlist size scored by the NN')
+    precompute_parser.add_argument('--batch_words', default=100, type=int, help='Number of words to shortlist at a time')
+    precompute_parser.add_argument('--batch_size', default=8192, type=int, help='Batch size of NN calls')
+    precompute_parser.set_defaults(fn=precompute)
+
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('--tf_model_dir', default='tm_lstm', help='Path to keras model')
+    export_parser.add_argument('--output_file', help='Output .npz file (default: <tf_model_dir>.npz)')
+    export_parser.set_defaults(fn=export)
+
+    compare_parser = subparsers.add_parser('compare_backends', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    compare_parser.add_argument('--tm_file', default='tm.pkl', help='Name of TM file')
+    compare_parser.add_argument('--numpy_model_file', help='Weights exported by the export command')
+    compare_parser.add_argument('--word_pairs_file', default=f'{tm_dir}/datasets/word_pairs/true/benchmark.tsv', help='TSV of (pi, en) word pairs')
+    compare_parser.add_argument('--n_words', default=200, type=int, help='Number of pi words to score')
+    compare_parser.add_argument('--n_candidates', default=200, type=int, help='Shortlist size per pi word')
+    compare_parser.add_argument('--batch_size', default=8192, type=int, help='Batch size of NN calls')
+    compare_parser.add_argument('--tolerance', default=1e-4, type=float, help='Max allowed abs difference of scores')
+    compare_parser.set_defaults(fn=compare_backends)
+
     args = parser.parse_args()
     if args.fn:
         args.fn(args)
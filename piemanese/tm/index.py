@@ -0,0 +1,57 @@
+from functools import reduce
+from collections import defaultdict
+import numpy as np
+
+class CandidateIndex:
+    """
+    Character n-gram inverted index over a word list. Used to shortlist
+    English candidates for a Piemanese word before neural scoring.
+    """
+    def __init__(self, words, n=2):
+        self.words = list(words)
+        self.n = n
+        postings = defaultdict(list)
+        n_grams = []
+        for i, word in enumerate(self.words):
+            grams = self._ngrams(word)
+            n_grams.append(len(grams))
+            for gram in grams:
+                postings[gram].append(i)
+        self.postings = {gram: np.array(ids, dtype=np.int32)
+            for gram, ids in postings.items()}
+        self.n_grams = np.array(n_grams, dtype=np.float32)
+
+    def _ngrams(self, word):
+        padded = f'^{word}$'
+        return {padded[i:i+self.n] for i in range(len(padded) - self.n + 1)}
+
+    def query(self, word, k=200):
+        """
+        Returns up to k words sharing at least one n-gram with word, ranked
+        by Dice coefficient of their n-gram sets.
+        """
+        grams = self._ngrams(word)
+        postings = [self.postings[g] for g in grams if g in self.postings]
+        if not postings:
+            return []
+        overlap = np.bincount(np.concatenate(postings),
+            minlength=len(self.words))
+        candidates = np.flatnonzero(overlap)
+        scores = 2 * overlap[candidates] / (len(grams)
+            + self.n_grams[candidates])
+        if k and len(candidates) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return [self.words[i] for i in candidates[order]]
+
+    def containing(self, word):
+        """Returns the words containing word as a substring."""
+        grams = {word[i:i+self.n] for i in range(len(word) - self.n + 1)}
+        if any(g not in self.postings for g in grams):
+            return []
+        if grams:
+            ids = reduce(np.intersect1d, [self.postings[g] for g in grams])
+        else:
+            ids = range(len(self.words))
+        return [self.words[i] for i in ids if word in self.words[i]]
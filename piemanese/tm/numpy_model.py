@@ -0,0 +1,307 @@
+import re
+import json
+import numpy as np
+
+# keras' default TextVectorization punctuation regex
+STRIP_PUNCTUATION_RE = re.compile(r'[!"#$%&()\*\+,-\./:;<=>?@\[\\\]^_`{|}~\']')
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0, 1),
+    'tanh': np.tanh,
+    'softmax': lambda x: np.exp(x - x.max(axis=-1, keepdims=True))
+        / np.exp(x - x.max(axis=-1, keepdims=True)).sum(axis=-1, keepdims=True)
+}
+
+def export_model(model, path):
+    """
+    Exports a functional keras model, its weights and those of any nested
+    models, to an .npz file that NumpyModel can run without tensorflow.
+    """
+    arrays = {}
+    graph = _export_graph(model, '', arrays)
+    np.savez(path, __graph__=np.array(json.dumps(graph)), **arrays)
+
+def _export_graph(model, prefix, arrays):
+    config = model.get_config()
+    sequential = 'input_layers' not in config
+    layer_configs = {} if sequential \
+        else {c['name']: c for c in config['layers']}
+    layers = []
+    for layer in model.layers:
+        name = f'{prefix}{layer.name}'
+        entry = {
+            'name': layer.name,
+            'class_name': layer.__class__.__name__,
+            'config': json.loads(json.dumps(layer.get_config(), default=str))
+        }
+        if not sequential:
+            entry['inbound_nodes'] = _inbound_nodes(
+                layer_configs[layer.name]['inbound_nodes'])
+        if hasattr(layer, 'layers'):
+            entry['graph'] = _export_graph(layer, f'{name}/', arrays)
+        else:
+            weights = layer.get_weights()
+            if hasattr(layer, 'get_vocabulary'):
+                arrays[f'{name}/vocabulary'] = np.array(layer.get_vocabulary())
+                weights = []
+            for i, weight in enumerate(weights):
+                arrays[f'{name}/{i}'] = weight
+            entry['n_weights'] = len(weights)
+        layers.append(entry)
+    graph = {'name': model.name, 'layers': layers, 'sequential': sequential}
+    if not sequential:
+        graph['inputs'] = [x[0] for x in config['input_layers']]
+        graph['outputs'] = [x[0] for x in config['output_layers']]
+    return graph
+
+def _inbound_nodes(nodes):
+    """
+    Normalizes inbound nodes of a layer config, in either the keras 2 or
+    keras 3 format, to [[(layer name, node index, tensor index)]].
+    """
+    def history(x):
+        if isinstance(x, dict):
+            if x.get('class_name') == '__keras_tensor__':
+                return [tuple(x['config']['keras_history'])]
+            return [h for v in x.values() for h in history(v)]
+        if isinstance(x, list):
+            if len(x) in [3, 4] and isinstance(x[0], str) \
+                    and isinstance(x[1], int):
+                return [tuple(x[:3])]
+            return [h for v in x for h in history(v)]
+        return []
+    return [history(node) for node in nodes]
+
+class NumpyModel:
+    """
+    NumPy forward pass of a keras model exported by export_model. Supports
+    the layers used by the TM models: InputLayer, TextVectorization,
+    Embedding, Concatenate, Conv1D, MaxPooling1D, Flatten, Dense,
+    Activation, Dropout, LSTM and Bidirectional, as well as nested models.
+    """
+    def __init__(self, graph, weights, prefix=''):
+        self.graph = graph
+        self.name = graph['name']
+        self.layers = {}
+        self.weights = {}
+        self.inbound_nodes = {layer['name']: layer.get('inbound_nodes')
+            for layer in graph['layers']}
+        for layer in graph['layers']:
+            name = f'{prefix}{layer["name"]}'
+            if 'graph' in layer:
+                self.layers[layer['name']] = NumpyModel(layer['graph'],
+                    weights, f'{name}/')
+                continue
+            self.layers[layer['name']] = layer
+            self.weights[layer['name']] = [weights[f'{name}/{i}']
+                for i in range(layer['n_weights'])]
+            if layer['class_name'] == 'TextVectorization':
+                vocabulary = weights[f'{name}/vocabulary'].tolist()
+                layer['vocabulary_ids'] = {token: i
+                    for i, token in enumerate(vocabulary)}
+                # code point -> id, for character split
+                chars = [t for t in vocabulary if len(t) == 1]
+                char_ids = np.full(max([ord(c) for c in chars] + [0]) + 1,
+                    layer['vocabulary_ids'].get('[UNK]', 1), dtype=np.int64)
+                for c in chars:
+                    char_ids[ord(c)] = layer['vocabulary_ids'][c]
+                char_ids[0] = 0
+                layer['char_ids'] = char_ids
+            if layer['class_name'] == 'Embedding' \
+                    and layer['config'].get('mask_zero'):
+                raise NotImplementedError('Masked embeddings are not supported')
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            weights = {k: f[k] for k in f.files}
+        return cls(json.loads(str(weights.pop('__graph__'))), weights)
+
+    def __call__(self, inputs):
+        """
+        inputs: array or list of arrays, one per model input.
+        returns: array, or list of arrays if the model has many outputs.
+        """
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        if self.graph['sequential']:
+            x = inputs[0]
+            for layer in self.graph['layers']:
+                x = self._call_layer(layer['name'], [x])
+            return x
+        tensors = {(name, 0, 0): x
+            for name, x in zip(self.graph['inputs'], inputs)}
+        outputs = [self._tensor((name, 0, 0), tensors)
+            for name in self.graph['outputs']]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def _tensor(self, key, tensors):
+        """Computes the output of a layer call, memoized in tensors."""
+        if key not in tensors:
+            name, node_index, _ = key
+            node = self.inbound_nodes[name][node_index]
+            inputs = [self._tensor(tuple(k), tensors) for k in node]
+            outputs = self._call_layer(name, inputs)
+            if not isinstance(outputs, list):
+                outputs = [outputs]
+            for i, output in enumerate(outputs):
+                tensors[(name, node_index, i)] = output
+        return tensors[key]
+
+    def _call_layer(self, name, inputs):
+        layer = self.layers[name]
+        if isinstance(layer, NumpyModel):
+            return layer(inputs)
+        fn = getattr(self, f'_{layer["class_name"].lower()}', None)
+        if fn is None:
+            raise NotImplementedError(f'Unsupported layer: {layer["class_name"]}')
+        return fn(layer['config'], self.weights[name], inputs, layer)
+
+    def _inputlayer(self, config, weights, inputs, layer):
+        return inputs[0]
+
+    def _dropout(self, config, weights, inputs, layer):
+        return inputs[0]
+
+    def _textvectorization(self, config, weights, inputs, layer):
+        texts = [t.decode() if isinstance(t, bytes) else str(t)
+            for t in np.asarray(inputs[0], dtype=object).reshape(-1)]
+        standardize = config.get('standardize')
+        if standardize in ['lower', 'lower_and_strip_punctuation']:
+            texts = [t.lower() for t in texts]
+        if standardize in ['strip_punctuation', 'lower_and_strip_punctuation']:
+            texts = [STRIP_PUNCTUATION_RE.sub('', t) for t in texts]
+        split = config.get('split')
+        vocabulary_ids = layer['vocabulary_ids']
+        oov = vocabulary_ids.get('[UNK]', 1)
+        seq_len = config.get('output_sequence_length') \
+            or max([len(t) for t in texts] + [1])
+        if split == 'character':
+            # fixed width unicode array, truncated and zero padded, viewed
+            # as code points which are mapped to ids with a lookup table
+            codes = np.array(texts, dtype=f'<U{seq_len}').view(np.uint32)
+            codes = codes.reshape(len(texts), seq_len)
+            char_ids = layer['char_ids']
+            return np.where(codes < len(char_ids),
+                char_ids[np.minimum(codes, len(char_ids) - 1)], oov)
+        if split == 'whitespace':
+            tokens = [t.split() for t in texts]
+        else:
+            tokens = [[t] for t in texts]
+        ids = np.zeros((len(tokens), seq_len), dtype=np.int64)
+        for i, t in enumerate(tokens):
+            t = [vocabulary_ids.get(c, oov) for c in t[:seq_len]]
+            ids[i, :len(t)] = t
+        return ids
+
+    def _embedding(self, config, weights, inputs, layer):
+        return weights[0][inputs[0]]
+
+    def _concatenate(self, config, weights, inputs, layer):
+        return np.concatenate(inputs, axis=config.get('axis', -1))
+
+    def _flatten(self, config, weights, inputs, layer):
+        return inputs[0].reshape(len(inputs[0]), -1)
+
+    def _activation(self, config, weights, inputs, layer):
+        return ACTIVATIONS[config['activation']](inputs[0])
+
+    def _dense(self, config, weights, inputs, layer):
+        x = inputs[0] @ weights[0]
+        if config.get('use_bias', True):
+            x = x + weights[1]
+        return ACTIVATIONS[config.get('activation', 'linear')](x)
+
+    def _conv1d(self, config, weights, inputs, layer):
+        x = inputs[0]  # (B, S, C)
+        kernel = weights[0]  # (K, C, F)
+        k = kernel.shape[0]
+        stride = _int(config.get('strides', 1))
+        dilation = _int(config.get('dilation_rate', 1))
+        span = (k - 1) * dilation + 1
+        padding = config.get('padding', 'valid')
+        if padding == 'same':
+            total = max((-(-x.shape[1] // stride) - 1) * stride + span
+                - x.shape[1], 0)
+            x = np.pad(x, [(0, 0), (total // 2, total - total // 2), (0, 0)])
+        elif padding == 'causal':
+            x = np.pad(x, [(0, 0), (span - 1, 0), (0, 0)])
+        # one matmul per kernel tap, over the inputs that tap sees
+        length = (x.shape[1] - span) // stride + 1
+        x = sum(x[:, j*dilation:j*dilation+(length-1)*stride+1:stride]
+            @ kernel[j] for j in range(k))
+        if config.get('use_bias', True):
+            x = x + weights[1]
+        return ACTIVATIONS[config.get('activation', 'linear')](x)
+
+    def _maxpooling1d(self, config, weights, inputs, layer):
+        x = inputs[0]
+        pool = _int(config.get('pool_size', 2))
+        stride = _int(config.get('strides') or pool)
+        if config.get('padding', 'valid') == 'same':
+            total = max((-(-x.shape[1] // stride) - 1) * stride + pool
+                - x.shape[1], 0)
+            x = np.pad(x, [(0, 0), (total // 2, total - total // 2), (0, 0)],
+                constant_values=-np.inf)
+        windows = np.lib.stride_tricks.sliding_window_view(x, pool, axis=1)
+        return windows[:, ::stride].max(axis=-1)
+
+    def _lstm(self, config, weights, inputs, layer):
+        return self._run_lstm(config, weights, inputs[0])
+
+    def _bidirectional(self, config, weights, inputs, layer):
+        rnn_config = config['layer']['config']
+        if config['layer'].get('class_name', 'LSTM') != 'LSTM':
+            raise NotImplementedError('Only bidirectional LSTMs are supported')
+        n = len(weights) // 2
+        forward = self._run_lstm(rnn_config, weights[:n], inputs[0])
+        backward = self._run_lstm({**rnn_config,
+            'go_backwards': not rnn_config.get('go_backwards', False)},
+            weights[n:], inputs[0])
+        if rnn_config.get('return_sequences'):
+            # backward outputs are in reversed time order
+            backward = backward[:, ::-1]
+        merge_mode = config.get('merge_mode', 'concat')
+        if merge_mode == 'concat':
+            return np.concatenate([forward, backward], axis=-1)
+        if merge_mode == 'sum':
+            return forward + backward
+        if merge_mode == 'mul':
+            return forward * backward
+        if merge_mode == 'ave':
+            return (forward + backward) / 2
+        raise NotImplementedError(f'Unsupported merge mode: {merge_mode}')
+
+    def _run_lstm(self, config, weights, x):
+        """Keras LSTM with gates in (input, forget, cell, output) order."""
+        kernel, recurrent_kernel = weights[0], weights[1]
+        bias = weights[2] if config.get('use_bias', True) else 0
+        activation = ACTIVATIONS[config.get('activation', 'tanh')]
+        recurrent_activation = ACTIVATIONS[
+            config.get('recurrent_activation', 'sigmoid')]
+        if config.get('go_backwards'):
+            x = x[:, ::-1]
+        units = recurrent_kernel.shape[0]
+        # input projections of all time steps at once
+        x_proj = x @ kernel + bias  # (B, S, 4U)
+        h = np.zeros((len(x), units), dtype=x_proj.dtype)
+        c = np.zeros((len(x), units), dtype=x_proj.dtype)
+        outputs = []
+        for t in range(x.shape[1]):
+            z = x_proj[:, t] + h @ recurrent_kernel
+            i = recurrent_activation(z[:, :units])
+            f = recurrent_activation(z[:, units:2*units])
+            c = f * c + i * activation(z[:, 2*units:3*units])
+            o = recurrent_activation(z[:, 3*units:])
+            h = o * activation(c)
+            outputs.append(h)
+        if config.get('return_sequences'):
+            return np.stack(outputs, axis=1)
+        return h
+
+def _int(x):
+    """Keras stores 1D sizes as ints or 1-tuples."""
+    return x[0] if isinstance(x, (list, tuple)) else x
@@ -5,30 +5,78 @@ import random
 import json
 import os
 import re
+import multiprocessing
 import Levenshtein
 from tqdm import tqdm
+from piemanese.tm.index import CandidateIndex
+
+_worker_index = None
+
+def _init_worker(vocab_words):
+    global _worker_index
+    _worker_index = CandidateIndex(vocab_words)
+
+def _similar_words(index, word, n, n_candidates, rng):
+    """
+    Similar but different vocab words to pair with word: the n most
+    similar of its n_candidates index candidates by Levenshtein ratio, the
+    n least similar of 4n random words, and the n least similar words
+    containing word, which are the longest ones.
+    """
+    key = word.replace("'", '')
+    def ratios(words):
+        return sorted([(Levenshtein.ratio(word, w) + rng.random() * .01, w)
+            for w in words if w.replace("'", '') != key], reverse=True)
+    most = ratios(index.query(word, n_candidates))[:n]
+    least = ratios(rng.choices(index.words, k=4 * n))[-n:]
+    # for w containing word, ratio = 2 * len(word) / (len(word) + len(w))
+    containing = sorted([(-len(w) + rng.random() * .01, w)
+        for w in index.containing(word)
+        if w != word and w.replace("'", '') != key], reverse=True)[-n:]
+    return list(dict.fromkeys(w for _, w in most + least + containing))
+
+def _false_pairs_chunk(job):
+    seed, words, n, n_candidates = job
+    rng = random.Random(seed)
+    return [(word, w) for word in words
+        for w in _similar_words(_worker_index, word, n, n_candidates, rng)]
+
+def mine_false_pairs(vocab_words, en_words, n, n_candidates=200,
+        n_workers=1, chunk_size=256, seed=0):
+    """
+    Pairs each of en_words with similar but different vocab words, in a
+    process pool of n_workers. Chunk i is sampled with seed f'{seed}:{i}',
+    so results do not depend on n_workers.
+    """
+    jobs = [(f'{seed}:{i}', en_words[j:j+chunk_size], n, n_candidates)
+        for i, j in enumerate(range(0, len(en_words), chunk_size))]
+    false_pairs = []
+    if n_workers <= 1:
+        _init_worker(vocab_words)
+        for job in tqdm(jobs):
+            false_pairs += _false_pairs_chunk(job)
+        return false_pairs
+    with multiprocessing.Pool(n_workers, _init_worker,
+            (vocab_words,)) as pool:
+        for pairs in tqdm(pool.imap(_false_pairs_chunk, jobs),
+                total=len(jobs)):
+            false_pairs += pairs
+    return false_pairs
 
 def main(args):
+    random.seed(args.seed)
     # read english vocab
     with open(args.vocab_dir + '/vocab.txt', 'r') as f:
         vocab_words = [l.strip() for l in f]
     with open(args.vocab_dir + '/word_prob_mass.txt', 'r') as f:
         vocab_cum_weights = [float(l.split('\t')[0]) for l in f]
         vocab_cum_weights = vocab_cum_weights[:len(vocab_words)]
-    # generate false pairs from mismatching existing similar en words
-    false_pairs = []
+    # generate false pairs from mismatching existing similar en words,
+    # retrieved with an n-gram index instead of comparing to every word
     en_words = random.choices(vocab_words, cum_weights=vocab_cum_weights,
         k=len(vocab_words))
-    for word in tqdm(en_words):
-        word_ratios = [(Levenshtein.ratio(word, w) + random.random() * .01, w)
-            for w in vocab_words
-            if w.replace("'", '') != word.replace("'", '')]
-        word_ratios = sorted(word_ratios, reverse=True)
-        sim_words = [w for r, w in word_ratios if r > 0]
-        n = args.n_repeats//2
-        sim_words = set(sim_words[:n] + sim_words[-n:] + [w for w in sim_words
-            if w != word and word in w][-n:])
-        false_pairs += [(word, w) for w in sim_words]
+    false_pairs = mine_false_pairs(vocab_words, en_words, args.n_repeats//2,
+        args.n_candidates, args.n_workers, args.chunk_size, args.seed)
     with open(args.word_pairs_dir + '/false/vocab_similar.tsv', 'w') as f:
         f.writelines(f'{en1}\t{en2}\n' for en1, en2 in false_pairs)
     # generate true pairs from punctuation correction
@@ -83,6 +131,10 @@ if __name__ == '__main__':
     parser.add_argument('word_pairs_dir')
     parser.add_argument('vocab_dir')
     parser.add_argument('--n_repeats', type=int, default=20)
+    parser.add_argument('--n_candidates', type=int, default=200)
+    parser.add_argument('-n', '--n_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--pi_edits_file',
         default=f'{os.path.dirname(__file__)}/pi_edits.json')
     args = parser.parse_args()
@@ -2,63 +2,240 @@ import argparse
 import os.path
 import re
 import math
+import time
 import functools
+import threading
+from collections import OrderedDict
+import numpy as np
 import dill as pickle
-import tensorflow as tf
+from tqdm import tqdm
+from .index import CandidateIndex
+from .numpy_model import NumpyModel, export_model
+from ..metrics import timed
+
+# tensorflow is only imported once a word needs the NN, see _import_tf
+tf = None
+
+def _import_tf():
+    global tf
+    if tf is None:
+        import tensorflow
+        tf = tensorflow
+    return tf
+
+def load_replacements(replacements_file=None):
+    if not replacements_file:
+        replacements_file = f'{os.path.dirname(__file__)}/replacements.tsv'
+    replacements = {}
+    with open(replacements_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            pi, en = line.strip().split('\t')
+            replacements[pi] = en.split(',')
+    return replacements
+
+def load_en_vocab(vocab_dir=None):
+    if not vocab_dir:
+        vocab_dir = f'{os.path.dirname(__file__)}/../vocab'
+    with open(f'{vocab_dir}/vocab.txt', 'r') as f:
+        en_vocab = [line.strip() for line in f]
+    with open(f'{vocab_dir}/phrase_vocab.txt', 'r') as f:
+        en_vocab += [line.strip() for line in f]
+    with open(f'{vocab_dir}/names.txt', 'r') as f:
+        en_vocab += [line.strip() for line in f]
+    return list(dict.fromkeys(en_vocab))
 
 class TranslationModel:
     def __init__(self, replacements=None, en_vocab=None,
-            tf_model_dir='tm_lstm'):
+            tf_model_dir='tm_lstm', score_table=None, cache_size=100000,
+            backend='tf', numpy_model_file=None):
+        """
+        cache_size: max number of NN scored words kept in the LRU cache.
+        backend='tf': run the keras model in tf_model_dir.
+        backend='numpy': run the weights exported from it by the export
+            command (numpy_model_file, tf_model_dir + '.npz' by default)
+            with numpy, without importing tensorflow at all.
+        The NN is only loaded (and tensorflow imported) when first needed,
+        or ahead of time by load_model or warm_up.
+        """
+        if backend not in ['tf', 'numpy']:
+            raise ValueError(f'Unknown backend: {backend}')
         if not replacements:
-            replacements = {}
-            replacements_file = f'{os.path.dirname(__file__)}/replacements.tsv'
-            with open(replacements_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    pi, en = line.strip().split('\t')
-                    replacements[pi] = en.split(',')
+            replacements = load_replacements()
         self.replacements = replacements
-        self.en_vocab = []
-        vocab_dir = f'{os.path.dirname(__file__)}/../vocab'
-        if not en_vocab:
-            en_vocab = vocab_dir
-        if isinstance(en_vocab, str):
-            with open(f'{en_vocab}/vocab.txt', 'r') as f:
-                self.en_vocab = [line.strip() for line in f]
-            with open(f'{en_vocab}/phrase_vocab.txt', 'r') as f:
-                self.en_vocab += [line.strip() for line in f]
-            with open(f'{en_vocab}/names.txt', 'r') as f:
-                self.en_vocab += [line.strip() for line in f]
-            self.en_vocab = list(dict.fromkeys(self.en_vocab))
-        else:
-            self.en_vocab = en_vocab
+        self.repeat_re = re.compile(r'(.)\1+')
+        self.replacement_trie = self._build_replacement_trie()
+        if not en_vocab or isinstance(en_vocab, str):
+            en_vocab = load_en_vocab(en_vocab)
+        self.en_vocab = en_vocab
+        self.en_index = CandidateIndex(self.en_vocab)
+        # precomputed top-k NN scores: pi_word -> ((en_word, p), ...)
+        self.score_table = score_table or {}
         self.tf_model_dir = tf_model_dir
-        self.model = tf.keras.models.load_model(tf_model_dir)
+        self.backend = backend
+        self.numpy_model_file = numpy_model_file
+        self.model = None
+        self.model_lock = threading.Lock()
+        # seconds spent importing tensorflow and loading the NN
+        self.model_load_times = {}
         self.word_re = re.compile(r"^[a-z][a-z0-9']*$")
         self.pi_word_clean_re = re.compile(r'([a-z])\1{2,}')
+        # LRU cache of NN scores: (pi_word, threshold, top_n, n_candidates)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        # optional Metrics, see Translator.set_metrics
+        self.metrics = None
+
+    def load_model(self):
+        """Loads the NN (importing tensorflow if needed), unless loaded."""
+        with self.model_lock:
+            if self.model is not None:
+                return self.model
+            start = time.perf_counter()
+            if self.backend == 'numpy':
+                model = NumpyModel.load(self.numpy_model_file
+                    or f'{self.tf_model_dir}.npz')
+            else:
+                _import_tf()
+                self.model_load_times['tf_import'] = \
+                    time.perf_counter() - start
+                start = time.perf_counter()
+                model = tf.keras.models.load_model(self.tf_model_dir)
+            self.model_load_times['model_load'] = time.perf_counter() - start
+            self.model = model
+            return model
+
+    def warm_up(self):
+        """Loads the NN in a background thread. returns: the thread."""
+        thread = threading.Thread(target=self.load_model, daemon=True,
+            name='tm_warm_up')
+        thread.start()
+        return thread
+
+    def _build_replacement_trie(self):
+        """
+        Token trie of the (possibly multi-word) replacement keys, by repeat
+        collapsed token. Each terminal, under the None key, maps the
+        original tokens of the keys ending there to the key.
+        """
+        trie = {}
+        for key in self.replacements:
+            tokens = tuple(key.split())
+            node = trie
+            for token in tokens:
+                node = node.setdefault(self.repeat_re.sub(r'\1', token), {})
+            node.setdefault(None, {})[tokens] = key
+        return trie
+
+    def match_replacement(self, pi_words, start=0, end=None):
+        """
+        Longest replacement key matching pi_words[start:end] from start,
+        either exactly or after collapsing repeated characters, preferring
+        an exact match.
+
+        returns: (end of the match, key) or None
+        """
+        end = len(pi_words) if end is None else end
+        node = self.replacement_trie
+        collapsed = []
+        match = None
+        for i in range(start, end):
+            collapsed.append(self.repeat_re.sub(r'\1', pi_words[i]))
+            node = node.get(collapsed[-1])
+            if node is None:
+                break
+            if None in node:
+                keys = node[None]
+                key = keys.get(tuple(pi_words[start:i+1])) \
+                    or keys.get(tuple(collapsed))
+                if key is not None:
+                    match = (i + 1, key)
+        return match
 
     def _get_replacements(self, pi_word):
-        variations = [
-            pi_word,
-            re.sub(r'(.)\1+', r'\1', pi_word)
-        ]
-        found = [w for w in variations if w in self.replacements]
-        if not found:
+        """pi_word: a word, or a phrase matched by match_replacement"""
+        pi_tokens = pi_word.split()
+        match = self.match_replacement(pi_tokens)
+        if match is None or match[0] != len(pi_tokens):
             return None
-        replacements = self.replacements[found[0]]
-        # TODO precompute replacement probabilities from NN and store in pkl
+        key = match[1]
+        if key in self.score_table:
+            return dict(self.score_table[key])
+        replacements = self.replacements[key]
         return {w: 1 / len(replacements) for w in replacements}
 
-    def clean_words(self, pi_words):
-        return [self.pi_word_clean_re.sub(r'\1\1', w) for w in pi_words]
+    def _model_scores(self, pi_words, en_words, batch_size=None):
+        """Run the NN over (pi, en) pairs and return p(pi|e) per pair."""
+        if not pi_words:
+            return np.zeros(0)
+        self.load_model()
+        if not batch_size:
+            batch_size = len(pi_words)
+        out_probs = []
+        for i in range(0, len(pi_words), batch_size):
+            if self.backend == 'numpy':
+                out_probs.append(self.model([
+                    np.array(pi_words[i:i+batch_size], dtype=object),
+                    np.array(en_words[i:i+batch_size], dtype=object)
+                ]).reshape(-1))
+                continue
+            in_tensor = [
+                tf.constant(pi_words[i:i+batch_size]),
+                tf.constant(en_words[i:i+batch_size])
+            ]
+            out_tensor = self.model.call(in_tensor, training=False)
+            out_probs.append(tf.reshape(out_tensor, [-1]).numpy())
+        return np.concatenate(out_probs)
 
-    def multiple_scores(self, pi_words, threshold=0.5):
-        """Compute the TM likelihood p(pi|e) over all e, for all inputs pi."""
-        scores = {}
+    def _nn_scores(self, pi_words, n_candidates=200, batch_size=None):
+        """
+        Score the shortlisted candidates of each pi word with the NN.
+        returns: {pi_word: [(en_word, p)]} sorted by descending p.
+        """
         # get vocab lengths so we can split output tensor afterwards
-        en_vocabs = [self.en_vocab]
         en_vocab_lengths = []
         en_vocab_all = []
         pi_words_all = []
+        for pi_word in pi_words:
+            # shortlist by character n-gram similarity before the NN
+            en_heur = self.en_index.query(pi_word, n_candidates)
+            en_vocab_all += en_heur
+            en_vocab_lengths.append(len(en_heur))
+            pi_words_all += [pi_word] * len(en_heur)
+        if self.metrics is not None:
+            self.metrics.inc('nn_pairs', len(pi_words_all))
+        out_probs = self._model_scores(pi_words_all, en_vocab_all, batch_size)
+        # split by vocab lengths
+        scores = {}
+        i = 0
+        for pi_word, n in zip(pi_words, en_vocab_lengths):
+            en_scores = zip(en_vocab_all[i:i+n], out_probs[i:i+n].tolist())
+            scores[pi_word] = sorted(en_scores, key=lambda x: -x[1])
+            i += n
+        return scores
+
+    def _filter_scores(self, pi_word, en_scores, threshold, top_n):
+        en_scores = [(w, p) for w, p in en_scores if p >= threshold]
+        if not en_scores:
+            return {pi_word: 1}
+        return dict(en_scores[:top_n] if top_n else en_scores)
+
+    def clean_words(self, pi_words):
+        return [self.pi_word_clean_re.sub(r'\1\1', w) for w in pi_words]
+
+    def multiple_scores(self, pi_words, threshold=0.5, top_n=None,
+            n_candidates=200):
+        """
+        Compute the TM likelihood p(pi|e) over e, for all inputs pi.
+        Only the n_candidates most similar e by the candidate index are
+        scored by the NN, and only the top_n best scoring e are returned.
+        """
+        scores = {}
+        nn_words = []
+        # where each unique word's scores came from, for metrics
+        sources = []
         for pi_word in pi_words:
             if pi_word in scores:
                 continue
@@ -68,56 +245,91 @@ class TranslationModel:
             replacements = self._get_replacements(pi_word)
             if replacements is not None:
                 scores[pi_word] = replacements
+                sources.append('replacement')
                 continue
             if not self.word_re.match(pi_word):
                 scores[pi_word] = {pi_word: 1}
+                sources.append('non_word')
                 continue
-            pi_chars = set(pi_word)
-            for en_vocab in en_vocabs:
-                # filter by heuristic first: levenshtein ratio > 0
-                # e.g. there is at least one common character
-                en_heur = [w for w in en_vocab if any(c in pi_chars for c in w)]
-                en_vocab_all += en_heur
-                en_vocab_lengths.append(len(en_heur))
-                pi_words_all += [pi_word] * len(en_heur)
+            if pi_word in self.score_table:
+                scores[pi_word] = self._filter_scores(pi_word,
+                    self.score_table[pi_word], threshold, top_n)
+                sources.append('score_table')
+                continue
+            cache_key = (pi_word, threshold, top_n, n_candidates)
+            if cache_key in self.cache:
+                self.cache.move_to_end(cache_key)
+                self.cache_hits += 1
+                scores[pi_word] = self.cache[cache_key]
+                sources.append('cache')
+                continue
+            self.cache_misses += 1
+            scores[pi_word] = None
+            nn_words.append(pi_word)
+            sources.append('nn')
+        if self.metrics is not None:
+            for source in sources:
+                self.metrics.inc(f'tm_words_{source}')
         # tf model call
-        if not pi_words_all:
+        if not nn_words:
             return scores
-        in_tensor = [
-            tf.constant(pi_words_all),
-            tf.constant(en_vocab_all)
-        ]
-        out_tensor = self.model.call(in_tensor, training=False)
-        out_probs = tf.reshape(out_tensor, [-1]).numpy()
-        # split by vocab lengths
-        i = 0
-        for n in en_vocab_lengths:
-            if n == 0:
-                continue
-            pi_word = pi_words_all[i]
-            if pi_word not in scores:
-                en_scores = {en_vocab_all[j]: out_probs[j]
-                    for j in range(i, i+n) if out_probs[j] >= threshold}
-                if not en_scores:
-                    en_scores = {pi_word: 1}
-                scores[pi_word] = en_scores
-            i += n
+        with timed(self.metrics, 'nn'):
+            nn_scores = self._nn_scores(nn_words, n_candidates)
+        for pi_word, en_scores in nn_scores.items():
+            scores[pi_word] = self._filter_scores(pi_word, en_scores,
+                threshold, top_n)
+            self._cache_put((pi_word, threshold, top_n, n_candidates),
+                scores[pi_word])
         return scores
 
+    def _cache_put(self, key, value):
+        if self.cache_size <= 0:
+            return
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+            self.cache_evictions += 1
+
+    def cache_stats(self):
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions,
+            'hit_rate': self.cache_hits / lookups if lookups else 0,
+            'size': len(self.cache),
+            'max_size': self.cache_size
+        }
+
+    def save_cache(self, path):
+        """Dump the score cache, least recently used first."""
+        with open(path, 'wb') as f:
+            pickle.dump(list(self.cache.items()), f)
+
+    def load_cache(self, path):
+        with open(path, 'rb') as f:
+            for key, value in pickle.load(f):
+                self._cache_put(key, value)
+
     def save(self, path):
         # TODO: save tf model as well
         with open(path, 'wb') as f:
             data = {
                 'replacements': self.replacements,
                 'en_vocab': self.en_vocab,
-                'tf_model_dir': self.tf_model_dir
+                'tf_model_dir': self.tf_model_dir,
+                'score_table': self.score_table,
+                'backend': self.backend,
+                'numpy_model_file': self.numpy_model_file
             }
             pickle.dump(data, f)
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, **kwargs):
+        """kwargs override the saved constructor arguments."""
         with open(path, 'rb') as f:
-            return cls(**pickle.load(f))
+            return cls(**{**pickle.load(f), **kwargs})
 
 def debug(args):
     tm = TranslationModel.load(args.tm_file)
@@ -127,7 +339,127 @@ def debug(args):
         for pi_word, en_word_scores in scores.items():
             print(pi_word, sorted(en_word_scores.items(), key=lambda x: -x[1]))
 
+def recall(args):
+    """Report how often the true English word survives the shortlist."""
+    en_vocab = load_en_vocab(args.vocab_dir)
+    en_vocab_set = set(en_vocab)
+    replacements = load_replacements()
+    index = CandidateIndex(en_vocab)
+    word_re = re.compile(r"^[a-z][a-z0-9']*$")
+    pairs = []
+    with open(args.word_pairs_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            pi, en = line.strip().split('\t')
+            # only words that would actually be sent to the NN
+            if not word_re.match(pi) or pi in replacements \
+                    or re.sub(r'(.)\1+', r'\1', pi) in replacements:
+                continue
+            pairs.append((pi, en))
+    reachable = [(pi, en) for pi, en in pairs if en in en_vocab_set]
+    print(f'{len(pairs)} NN word pairs, {len(reachable)} with e in vocab')
+    print('\t'.join(['k', 'recall', 'recall_in_vocab', 'avg_candidates']))
+    for k in args.k:
+        hits = 0
+        n_candidates = 0
+        for pi, en in pairs:
+            candidates = index.query(pi, k)
+            n_candidates += len(candidates)
+            hits += en in candidates
+        print('\t'.join([str(k), f'{hits/len(pairs):.4f}',
+            f'{hits/len(reachable):.4f}', f'{n_candidates/len(pairs):.1f}']))
+
+def precompute(args):
+    """Store top-k NN scores of the most frequent Piemanese words."""
+    tm = TranslationModel.load(args.tm_file)
+    tm.score_table = {}
+    punc_re = re.compile(r"^([a-z][a-z0-9']*)[?.!,]+$")
+    pi_words = {}
+    with open(args.freq_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if len(pi_words) >= args.n_words:
+                break
+            word = line.split()[0].lower()
+            word = punc_re.sub(r'\1', word)
+            word = tm.clean_words([word])[0]
+            if word in ['<s>', '</s>'] or not tm.word_re.match(word) \
+                    or tm._get_replacements(word) is not None:
+                continue
+            pi_words[word] = None
+    pi_words = list(pi_words)
+    for i in tqdm(range(0, len(pi_words), args.batch_words)):
+        batch = pi_words[i:i+args.batch_words]
+        nn_scores = tm._nn_scores(batch, args.n_candidates, args.batch_size)
+        for pi_word, en_scores in nn_scores.items():
+            tm.score_table[pi_word] = tuple(en_scores[:args.top_k])
+    # replace uniform replacement probabilities with normalized NN scores
+    pi_words_all = []
+    en_words_all = []
+    for pi_word, en_words in tm.replacements.items():
+        if len(en_words) > 1:
+            pi_words_all += [pi_word] * len(en_words)
+            en_words_all += en_words
+    out_probs = tm._model_scores(pi_words_all, en_words_all,
+        args.batch_size).tolist()
+    i = 0
+    for pi_word, en_words in tm.replacements.items():
+        if len(en_words) > 1:
+            probs = out_probs[i:i+len(en_words)]
+            z = sum(probs)
+            if z > 0:
+                tm.score_table[pi_word] = tuple((w, p / z)
+                    for w, p in zip(en_words, probs))
+            i += len(en_words)
+    tm.save(args.tm_file)
+    print(f'Saved {len(tm.score_table)} precomputed words to', args.tm_file)
+
+def export(args):
+    """Export the keras model's weights for the numpy backend."""
+    _import_tf()
+    model = tf.keras.models.load_model(args.tf_model_dir)
+    output_file = args.output_file or f'{args.tf_model_dir}.npz'
+    export_model(model, output_file)
+    print('Exported to', output_file)
+
+def compare_backends(args):
+    """
+    Check that the numpy backend reproduces the tf model's scores, on the
+    shortlisted candidates of the pi words of a word pairs file, and
+    compare their throughput.
+    """
+    tms = {backend: TranslationModel.load(args.tm_file, backend=backend,
+            numpy_model_file=args.numpy_model_file)
+        for backend in ['tf', 'numpy']}
+    with open(args.word_pairs_file, 'r', encoding='utf-8') as f:
+        pi_words = list(dict.fromkeys(line.split('\t')[0] for line in f))
+    pi_words = pi_words[:args.n_words]
+    tm = tms['tf']
+    pi_words_all = []
+    en_words_all = []
+    for pi_word in pi_words:
+        en_heur = tm.en_index.query(pi_word, args.n_candidates)
+        pi_words_all += [pi_word] * len(en_heur)
+        en_words_all += en_heur
+    print(f'{len(pi_words)} pi words, {len(pi_words_all)} pairs')
+    out_probs = {}
+    for backend, tm in tms.items():
+        tm.load_model()
+        # warm up, then time
+        tm._model_scores(pi_words_all[:args.batch_size],
+            en_words_all[:args.batch_size], args.batch_size)
+        start = time.perf_counter()
+        out_probs[backend] = tm._model_scores(pi_words_all, en_words_all,
+            args.batch_size)
+        elapsed = time.perf_counter() - start
+        print(f'{backend}: {len(pi_words_all)/elapsed:.0f} pairs/s, '
+            f'load {sum(tm.model_load_times.values()):.2f}s')
+    diff = np.abs(out_probs['tf'] - out_probs['numpy'])
+    print(f'max abs diff: {diff.max():.3g}, mean abs diff: {diff.mean():.3g}')
+    if diff.max() > args.tolerance:
+        raise SystemExit(f'Backends differ by more than {args.tolerance}')
+    print('Backends match within', args.tolerance)
+
 def train(args):
-    tm = TranslationModel()
+    tm = TranslationModel(backend=args.backend,
+        numpy_model_file=args.numpy_model_file)
     tm.save(args.tm_file)
     print('Saved to', args.tm_file)
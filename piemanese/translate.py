@@ -0,0 +1,92 @@
+import sys
+import argparse
+import fileinput
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+_worker_translator = None
+
+def _init_worker(translator_kwargs):
+    global _worker_translator
+    from .translator import Translator
+    _worker_translator = Translator(**translator_kwargs)
+
+def _run_chunk(job):
+    chunk_fn, chunk, batch_size = job
+    return chunk_fn(_worker_translator, chunk, batch_size)
+
+def translate_lines(translator, pi_lines, batch_size):
+    return translator.translate_batch(pi_lines, batch_size)
+
+def read_chunks(lines, chunk_size):
+    """Groups lines, without their newlines, into lists of chunk_size."""
+    lines = (line.rstrip('\r\n') for line in lines)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def translator_pool(translator_kwargs, n_workers):
+    """Process pool of n_workers, each holding its own Translator."""
+    return multiprocessing.Pool(n_workers, _init_worker, (translator_kwargs,))
+
+def translate_chunks(chunks, translator_kwargs, n_workers=1, batch_size=64,
+        max_pending=None, chunk_fn=translate_lines, pool=None):
+    """
+    Translates chunks of lines in a process pool of n_workers, each holding
+    its own Translator built from translator_kwargs. Results are yielded in
+    input order, with at most max_pending chunks (default 2 per worker)
+    read ahead so memory stays bounded on arbitrarily long inputs.
+    chunk_fn(translator, chunk, batch_size) processes a chunk, and must be
+    a module level function so that it can be sent to the workers.
+    pool: a translator_pool of n_workers to reuse across calls, so the
+        workers only load the models once.
+    """
+    if pool is None and n_workers <= 1:
+        _init_worker(translator_kwargs)
+        for chunk in chunks:
+            yield _run_chunk((chunk_fn, chunk, batch_size))
+        return
+    if pool is None:
+        with translator_pool(translator_kwargs, n_workers) as pool:
+            yield from translate_chunks(chunks, translator_kwargs, n_workers,
+                batch_size, max_pending, chunk_fn, pool)
+        return
+    max_pending = max_pending or 2 * n_workers
+    pending = deque()
+    for chunk in chunks:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(_run_chunk,
+            ((chunk_fn, chunk, batch_size),)))
+    while pending:
+        yield pending.popleft().get()
+
+def main(args):
+    translator_kwargs = {
+        'lm_file': args.lm_file,
+        'tm_file': args.tm_file,
+        'decoder_mode': args.decoder_mode
+    }
+    with fileinput.input(files=args.files or ['-']) as f:
+        chunks = read_chunks(f, args.chunk_size)
+        for en_lines in translate_chunks(chunks, translator_kwargs,
+                args.n_workers, args.batch_size):
+            sys.stdout.write(''.join(f'{line}\n' for line in en_lines))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Translate lines of files (or stdin) to stdout in order.')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('-n', '--n_workers', default=1, type=int)
+    parser.add_argument('--chunk_size', default=256, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--lm_file', default='lm.pkl')
+    parser.add_argument('--tm_file', default='tm.pkl')
+    parser.add_argument('--decoder_mode', default='beam', choices=['beam', 'viterbi'])
+    args = parser.parse_args()
+
+    main(args)
@@ -1,54 +1,133 @@
 import re
+import time
 import os.path
+_import_start = time.perf_counter()
 from .decoder import Decoder
 from .lm import LanguageModel
 from .tm import TranslationModel
+from .metrics import timed, Metrics
+from .matcher import PhraseMatcher, TokenClassifier
+IMPORT_SECONDS = time.perf_counter() - _import_start
 
 class Translator:
-    def __init__(self, vocab_dir=None, lm_file='lm.pkl', tm_file='tm.pkl'):
+    def __init__(self, vocab_dir=None, lm_file='lm.pkl', tm_file='tm.pkl',
+            tm_cache_file=None, decoder_mode='beam', warm_up=False):
+        """
+        The TM's NN is loaded on the first word that needs it. If warm_up,
+        it is loaded in a background thread right away instead.
+        """
+        self.startup_times = {'imports': IMPORT_SECONDS}
+        start = time.perf_counter()
         lm = LanguageModel.load(lm_file)
+        self.startup_times['lm_load'] = time.perf_counter() - start
+        start = time.perf_counter()
         tm = TranslationModel.load(tm_file)
-        self.decoder = Decoder(lm, tm)
+        self.tm_cache_file = tm_cache_file
+        if tm_cache_file and os.path.exists(tm_cache_file):
+            tm.load_cache(tm_cache_file)
+        self.startup_times['tm_load'] = time.perf_counter() - start
+        if warm_up:
+            tm.warm_up()
+        self.decoder = Decoder(lm, tm, mode=decoder_mode)
+        self.metrics = None
+        start = time.perf_counter()
         if not vocab_dir:
             vocab_dir = f'{os.path.dirname(__file__)}/vocab'
         with open(f'{vocab_dir}/pi_emotes.txt', 'r') as f:
-            self.pi_emotes = {line.strip() for line in f}
+            pi_emotes = {line.strip() for line in f}
         with open(f'{vocab_dir}/en_emotes.txt', 'r') as f:
             self.en_emotes = {line.strip() for line in f}
-        self.en_phrase_repl = []
+        en_phrase_repl = []
         with open(f'{vocab_dir}/en_phrase_replacements.tsv', 'r') as f:
             for line in f:
                 line = line.strip()
                 if not line:
                     continue
                 expr, repl = line.split('\t')
-                self.en_phrase_repl.append((re.compile(expr), repl))
-        self.no_repeat_re = re.compile(r'(.)\1+')
-        self.emote_re = re.compile(r'^([^a-z0-9]{3,})|(:[a-z])|([a-z]:)|(:\w+:)$')
+                en_phrase_repl.append((expr, repl))
+        self.en_phrase_matcher = PhraseMatcher(en_phrase_repl)
+        emote_re = re.compile(r'^([^a-z0-9]{3,})|(:[a-z])|([a-z]:)|(:\w+:)$')
+        self.is_pi_emote = TokenClassifier(pi_emotes, emote_re)
+        self.startup_times['vocab_load'] = time.perf_counter() - start
 
     def __call__(self, pi_sent, **kwargs):
         """Performs extra phrase replacement before and after decoding."""
-        if isinstance(pi_sent, str):
-            pi_tokens = self.tokenize(pi_sent)
-        elif isinstance(pi_sent, list):
-            pi_tokens = pi_sent
-        else:
-            pi_tokens = list(pi_sent)
-        pi_tokens_clean = self._remove_emotes_pre(pi_tokens)
+        start = time.perf_counter()
+        pi_tokens_clean = self._preprocess(pi_sent)
         en_tokens = self.decoder(pi_tokens_clean, **kwargs)[0][1]
-        en_tokens_clean = self._remove_emotes_post(en_tokens)
-        en_sent = ' '.join(en_tokens_clean)
-        for phrase_re, repl_re in self.en_phrase_repl:
-            en_sent = phrase_re.sub(repl_re, en_sent)
+        en_sent = self._postprocess(en_tokens)
+        if self.metrics is not None:
+            self.metrics.inc('translated_sentences')
+            self.metrics.observe('translate_seconds',
+                time.perf_counter() - start)
         return en_sent
 
+    def translate_batch(self, pi_sents, batch_size=64, **kwargs):
+        """
+        Translate many sentences, merging the TM inference of every
+        batch_size sentences into one call.
+        """
+        en_sents = []
+        for i in range(0, len(pi_sents), batch_size):
+            start = time.perf_counter()
+            pi_tokens_clean = [self._preprocess(pi_sent)
+                for pi_sent in pi_sents[i:i+batch_size]]
+            results = self.decoder.decode_batch(pi_tokens_clean, **kwargs)
+            en_sents += [self._postprocess(topn_sents[0][1])
+                for topn_sents in results]
+            if self.metrics is not None:
+                self.metrics.inc('translated_sentences', len(results))
+                self.metrics.observe('translate_batch_seconds',
+                    time.perf_counter() - start)
+        return en_sents
+
+    def set_metrics(self, metrics):
+        """
+        Record metrics of every component into a Metrics object, or stop
+        recording if None. returns: metrics
+        """
+        self.metrics = metrics
+        self.decoder.metrics = metrics
+        self.decoder.tm.metrics = metrics
+        self.decoder.lm.metrics = metrics
+        if metrics is not None:
+            tm = self.decoder.tm
+            metrics.add_gauges(lambda: {f'tm_cache_{key}': value
+                for key, value in tm.cache_stats().items()})
+        return metrics
+
+    def enable_metrics(self):
+        """Start recording metrics into a new Metrics object."""
+        return self.set_metrics(Metrics())
+
+    def _preprocess(self, pi_sent):
+        with timed(self.metrics, 'preprocess'):
+            if isinstance(pi_sent, str):
+                pi_tokens = self.tokenize(pi_sent)
+            elif isinstance(pi_sent, list):
+                pi_tokens = pi_sent
+            else:
+                pi_tokens = list(pi_sent)
+            return self._remove_emotes_pre(pi_tokens)
+
+    def _postprocess(self, en_tokens):
+        with timed(self.metrics, 'postprocess'):
+            en_tokens_clean = self._remove_emotes_post(en_tokens)
+            return self.en_phrase_matcher.sub(en_tokens_clean)
+
+    def startup_stats(self):
+        """Seconds spent per startup stage, including the lazy NN load."""
+        return {**self.startup_times, **self.decoder.tm.model_load_times}
+
+    def save_cache(self):
+        if self.tm_cache_file:
+            self.decoder.tm.save_cache(self.tm_cache_file)
+
     def tokenize(self, sent):
         return sent.lower().strip().split()
 
     def _remove_emotes_pre(self, pi_tokens):
-        return [w for w in pi_tokens
-            if self.no_repeat_re.sub(r'\1', w) not in self.pi_emotes
-            and not self.emote_re.match(w)]
+        return [w for w in pi_tokens if not self.is_pi_emote(w)]
 
     def _remove_emotes_post(self, en_tokens):
         return [w for w in en_tokens if w not in self.en_emotes]